@@ -1,8 +1,30 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from google import genai
 from google.genai import types
 import time
 import os
+import hashlib
+import json
+import pydantic
+import logging
+import concurrent.futures
+import threading
+import tempfile
+import httpx
+import uploads
+import result_cache
+import preprocess
+import async_loop
+import resilience
+import metrics
+import routing
+import preflight
+import artifacts
+import jobs
+import pipeline
+
+logger = logging.getLogger("student_assistant")
 
 # Set up page configuration
 st.set_page_config(page_title="The Student Assistant", page_icon="🧠", layout="wide")
@@ -15,19 +37,258 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+# Settings Helper
+def get_setting(name, default=None):
+    """
+    Read an optional setting from Streamlit Secrets, falling back to an environment variable.
+
+    :param name: The name of the setting.
+    :param default: The value to use if the setting is not configured anywhere.
+    :return: The configured value or the default.
+    """
+    if name in st.secrets:
+        return st.secrets[name]
+    return os.environ.get(name, default)
+
+# "files" uploads each file once through the Files API and reuses the reference,
+# "inline" sends the file bytes along with every request
+UPLOAD_MODE = get_setting("UPLOAD_MODE", "files")
+
+# Inline requests are limited in size, larger files always go through the Files API
+INLINE_MAX_BYTES = 20 * 1024 * 1024
+
+# Uploads are spooled to disk here so only Streamlit's own copy stays in memory
+SPOOL_DIR = get_setting("SPOOL_DIR", os.path.join(tempfile.gettempdir(), "student-assistant"))
+
+# Audio uploads are downmixed and re-encoded at speech quality before they are sent
+TRANSCODE_AUDIO = str(get_setting("TRANSCODE_AUDIO", "true")).lower() == "true"
+
+# Silent spans are removed from recordings, timestamps in responses are mapped back to the original
+TRIM_SILENCE = str(get_setting("TRIM_SILENCE", "true")).lower() == "true"
+
+# Videos are split into their audio track plus frames sampled on slide changes
+DECOMPOSE_VIDEO = str(get_setting("DECOMPOSE_VIDEO", "true")).lower() == "true"
+
+# Text-based PDFs are sent as their text layer, only scanned or image-heavy pages as PDF
+PDF_TEXT = str(get_setting("PDF_TEXT", "true")).lower() == "true"
+
+# Note images are downscaled to the resolution the model uses, optionally in high-contrast grayscale
+SHRINK_IMAGES = str(get_setting("SHRINK_IMAGES", "true")).lower() == "true"
+ENHANCE_IMAGES = str(get_setting("ENHANCE_IMAGES", "false")).lower() == "true"
+
+# Long recordings and documents are analysed in segments in parallel, then merged
+SEGMENT_LONG_MATERIAL = str(get_setting("SEGMENT_LONG_MATERIAL", "true")).lower() == "true"
+
+# Audio and video are transcribed once and every later request sends the transcript instead
+TRANSCRIPT_MODE = str(get_setting("TRANSCRIPT_MODE", "false")).lower() == "true"
+
+# Transient API failures (429, 5xx, network) are retried with backoff, within a per-call budget
+RETRY_POLICY = resilience.RetryPolicy(
+    max_attempts=int(get_setting("RETRY_MAX_ATTEMPTS", 4)),
+    max_delay=float(get_setting("RETRY_MAX_DELAY", 30)),
+    budget_seconds=float(get_setting("RETRY_BUDGET_SECONDS", 90))
+)
+
+# Requests that get no answer for this long fail as a timeout, which is retried and counts against the model's
+# circuit breaker, instead of holding a worker until the connection drops
+REQUEST_TIMEOUT_SECONDS = float(get_setting("REQUEST_TIMEOUT_SECONDS", 180))
+
+# Calls slower than this percentile of recent latencies get a duplicate request, the first answer wins
+HEDGE_REQUESTS = str(get_setting("HEDGE_REQUESTS", "false")).lower() == "true"
+HEDGE_PERCENTILE = float(get_setting("HEDGE_PERCENTILE", 95))
+HEDGE_MIN_DELAY = float(get_setting("HEDGE_MIN_DELAY", 2))
+HEDGE_MIN_SAMPLES = 20
+
+# Model tiers (most capable first), the tier of each workflow task and each task's latency objective in seconds,
+# given as tables in Streamlit Secrets or as "name=value,name=value" environment variables
+MODEL_TIERS = routing.parse_mapping(get_setting("MODEL_TIERS"))
+TASK_TIERS = routing.parse_mapping(get_setting("TASK_TIERS"))
+TASK_SLOS = routing.parse_mapping(get_setting("TASK_SLOS"), float)
+
+# A model whose calls keep failing is paused (calls fail fast) and probed again after a while
+CIRCUIT_FAILURE_RATE = float(get_setting("CIRCUIT_FAILURE_RATE", 0.5))
+CIRCUIT_MIN_CALLS = int(get_setting("CIRCUIT_MIN_CALLS", 5))
+CIRCUIT_OPEN_SECONDS = float(get_setting("CIRCUIT_OPEN_SECONDS", 30))
+
+# Requests and input tokens per minute allowed for each model (the API key's quotas, 0 for no limit),
+# calls over the limit wait for their turn instead of failing with 429
+RATE_LIMIT_RPM = int(get_setting("RATE_LIMIT_RPM", 1000))
+RATE_LIMIT_TPM = int(get_setting("RATE_LIMIT_TPM", 1_000_000))
+
+# Projected cost limit of the workflow for one upload (USD) and token limit of a single request,
+# material over budget is downgraded (lower media resolution, transcript only, fewer segments)
+WORKFLOW_BUDGET_USD = float(get_setting("WORKFLOW_BUDGET_USD", 0.5))
+REQUEST_TOKEN_BUDGET = int(get_setting("REQUEST_TOKEN_BUDGET", 1_000_000))
+
+# Workflows run as background jobs on this many worker threads, sessions poll them every JOB_POLL_SECONDS
+JOB_WORKERS = int(get_setting("JOB_WORKERS", 8))
+JOB_POLL_SECONDS = 1.0
+
+# Show the process-wide call metrics (retries, latencies, ...) in the sidebar
+SHOW_METRICS = str(get_setting("SHOW_METRICS", "false")).lower() == "true"
+
+DEFAULT_MODEL = "gemini-2.0-flash"
+
+# Prompts for the agent workflow
+TRANSCRIPT_PROMPT = """
+            Transcribe the attached lecture recording.
+            Start every paragraph with its [MM:SS] timestamp (use [H:MM:SS] past one hour).
+            Transcribe speech faithfully, leaving out filler words.
+            If there is video, briefly describe slides, board work and diagrams in [brackets] where they appear.
+            Output only the transcript.
+            """
+SUMMARY_PROMPT = """
+            Analyze the attached material deeply.
+            Create a 'Concept Map' Summary:
+            1. **Main Topic**: What is this primarily about?
+            2. **Core Concepts**: List the top 5-20 most important terms with definitions.
+            3. **The 'Aha!' Moment**: The most complex idea explained simply.
+            """
+FLASHCARD_PROMPT = """
+            Create a list of flashcards from this content.
+            The flashcards should be useful for studying the main course content covered and not any unrelevant information.
+            Generate 20 cards.
+            """
+FIRST_QUESTION_PROMPT = """
+            You are a rigorous but fair tutor providing a practice quiz to a student. 
+            Ask me the first distinct question based on the uploaded file. Do not give the answer.
+            """
+
+# Prompts that merge the per-segment results of long material (map-reduce)
+CONCEPT_MAP_REDUCE_PROMPT = """
+            Below are 'Concept Map' summaries of consecutive parts of the same material.
+            Merge them into a single 'Concept Map' Summary of the whole material:
+            1. **Main Topic**: What is this primarily about?
+            2. **Core Concepts**: List the top 5-20 most important terms with definitions, without duplicates.
+            3. **The 'Aha!' Moment**: The most complex idea explained simply.
+            """
+FLASHCARD_REDUCE_PROMPT = """
+            Below are flashcard lists made from consecutive parts of the same material.
+            Merge them into one list of the 20 most useful cards for studying the whole material, without duplicates.
+            """
+SEGMENT_REDUCE_PROMPTS = {
+    SUMMARY_PROMPT: CONCEPT_MAP_REDUCE_PROMPT,
+    FLASHCARD_PROMPT: FLASHCARD_REDUCE_PROMPT,
+}
+
+# Prompt that fixes a structured response which failed validation, without generating it again from the material
+REPAIR_PROMPT = """
+            The JSON below was meant to match the response schema, but validation failed with:
+            {error}
+            Return the corrected JSON, keeping its content.
+
+            {response}
+            """
+
+# Shared Result Cache
+# The shared resources are also used from background job threads, which can't show a spinner
+@st.cache_resource(show_spinner=False)
+def get_result_cache():
+    """
+    Create the result cache shared by every session in this process.
+
+    :return: The process-wide ResultCache.
+    """
+    return result_cache.ResultCache(
+        max_entries=int(get_setting("RESULT_CACHE_SIZE", 256)),
+        ttl_seconds=float(get_setting("RESULT_CACHE_TTL", 24 * 60 * 60)),
+        disk_dir=get_setting("RESULT_CACHE_DIR")
+    )
+
+# Shared Metrics
+@st.cache_resource(show_spinner=False)
+def get_metrics():
+    """
+    Create the metrics registry shared by every session in this process.
+
+    :return: The process-wide Metrics.
+    """
+    return metrics.Metrics()
+
+# Shared Model Router
+@st.cache_resource(show_spinner=False)
+def get_router():
+    """
+    Create the router that picks the model of every workflow task, shared by every session.
+
+    :return: The process-wide routing.Router.
+    """
+    return routing.Router(
+        get_metrics(),
+        tiers=MODEL_TIERS,
+        task_tiers=TASK_TIERS,
+        task_slos=TASK_SLOS,
+        breaker_options={
+            "failure_rate": CIRCUIT_FAILURE_RATE,
+            "min_calls": CIRCUIT_MIN_CALLS,
+            "open_seconds": CIRCUIT_OPEN_SECONDS,
+        },
+        limiter_options={
+            "requests_per_minute": RATE_LIMIT_RPM,
+            "tokens_per_minute": RATE_LIMIT_TPM,
+        }
+    )
+
+# Shared Gemini Client
+@st.cache_resource(max_entries=32)
+def get_client(api_key):
+    """
+    Create the Gemini client for an API key once and share it across reruns and sessions.
+
+    The client keeps a pool of keep-alive connections, so requests after the first one skip
+    client construction and the TLS handshake.
+
+    :param api_key: The Gemini API key.
+    :return: The genai.Client for that key.
+    """
+    pool_size = int(get_setting("HTTP_POOL_SIZE", 32))
+    limits = httpx.Limits(
+        max_connections=pool_size,
+        max_keepalive_connections=pool_size,
+        keepalive_expiry=float(get_setting("HTTP_KEEPALIVE_SECONDS", 300))
+    )
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            timeout=int(REQUEST_TIMEOUT_SECONDS * 1000),
+            client_args={"limits": limits},
+            async_client_args={"limits": limits}
+        )
+    )
+
+# Shared Job Runner
+@st.cache_resource(show_spinner=False)
+def get_job_runner():
+    """
+    Create the pool running the workflows of every session as background jobs.
+
+    :return: The process-wide jobs.JobRunner.
+    """
+    return jobs.JobRunner(get_metrics(), max_workers=JOB_WORKERS)
+
+# Shared Event Loop
+@st.cache_resource(show_spinner=False)
+def get_event_loop():
+    """
+    Start the background event loop that runs the Gemini calls of every session.
+
+    :return: The process-wide BackgroundLoop.
+    """
+    return async_loop.BackgroundLoop()
+
 # API Key Handling
 client = None
 if "GEMINI_API_KEY" in st.secrets:
     # If the API Key is available in Streamlit Secrets, use it
     api_key = st.secrets["GEMINI_API_KEY"]
-    client = genai.Client(api_key=api_key)
+    client = get_client(api_key)
 else:
     # If the API Key is not available, allow the user to enter their own
     with st.sidebar:
         st.title("🔐 Authorization")
         api_key = st.text_input("Gemini API Key", type="password")
         if api_key:
-            client = genai.Client(api_key=api_key)
+            client = get_client(api_key)
             st.success("API Key loaded!")
         else:
             st.warning("API Key required.")
@@ -35,46 +296,1086 @@ else:
 # Session State Initialization
 if "uploaded_file_ref" not in st.session_state:
     st.session_state.uploaded_file_ref = None
-if "current_file_name" not in st.session_state:
-    st.session_state.current_file_name = None
+if "remote_files" not in st.session_state:
+    st.session_state.remote_files = []
+if "source_file" not in st.session_state:
+    st.session_state.source_file = None
+if "segments" not in st.session_state:
+    st.session_state.segments = []
+if "preprocess_report" not in st.session_state:
+    st.session_state.preprocess_report = []
+if "transcript" not in st.session_state:
+    st.session_state.transcript = None
+if "current_file_digest" not in st.session_state:
+    st.session_state.current_file_digest = None
+if "current_upload_id" not in st.session_state:
+    st.session_state.current_upload_id = None
 if "workflow_status" not in st.session_state:
     st.session_state.workflow_status = "idle" # idle, processing, done
 if "concept_map" not in st.session_state:
     st.session_state.concept_map = None
-if "flashcards_csv" not in st.session_state:
-    st.session_state.flashcards_csv = None
+if "flashcards" not in st.session_state:
+    st.session_state.flashcards = None
 if "quiz_history" not in st.session_state:
     st.session_state.quiz_history = []
+if "artifact_errors" not in st.session_state:
+    st.session_state.artifact_errors = {}
+if "preflight" not in st.session_state:
+    st.session_state.preflight = None
+if "transcribe" not in st.session_state:
+    st.session_state.transcribe = False
+if "media_resolution" not in st.session_state:
+    st.session_state.media_resolution = None
+if "job_id" not in st.session_state:
+    st.session_state.job_id = None
+
+# Workflow State
+# Background jobs work on their own copy of these session state variables (see run_workflow). The quiz
+# conversation is not part of it, a job only returns the first question, since sessions share jobs
+WORKFLOW_STATE_KEYS = (
+    "uploaded_file_ref", "remote_files", "source_file", "segments", "preprocess_report", "transcript",
+    "current_file_digest", "concept_map", "flashcards", "artifact_errors", "preflight",
+    "transcribe", "media_resolution",
+)
+job_state = threading.local()
+
+
+def state():
+    """
+    Get the workflow state of the current thread: the state of the background job in job threads,
+    the session state otherwise.
+
+    :return: st.session_state or the job's state namespace.
+    """
+    current = getattr(job_state, "value", None)
+    return current if current is not None else st.session_state
+
+
+def sync_job(job, restore=False):
+    """
+    Copy the results of a background job into the session state.
+
+    :param job: The jobs.Job of this session.
+    :param restore: Copy the whole workflow state, for a new session attaching to the job (e.g. after a refresh).
+    """
+    keys = WORKFLOW_STATE_KEYS if restore else (
+        "uploaded_file_ref", "remote_files", "segments", "transcript", "concept_map", "flashcards"
+    )
+    for key in keys:
+        st.session_state[key] = getattr(job.state, key)
+    st.session_state.artifact_errors = dict(job.state.artifact_errors)
+    # The quiz may already be going on in this session
+    if not st.session_state.quiz_history and job.state.first_question:
+        st.session_state.quiz_history = [("assistant", job.state.first_question)]
+
+# File Reference Handling
+def upload_part(path, mime_type, display_name, key, inline):
+    """
+    Turn a single spooled file into a request Part.
+
+    :param path: Path of the file.
+    :param mime_type: The MIME type of the file.
+    :param display_name: Human readable name shown in the Files API.
+    :param key: The content key of the file.
+    :param inline: Whether to carry the bytes in the Part instead of uploading the file.
+    :return: A (part, remote_file) tuple, remote_file being None for inline Parts.
+    """
+    if inline:
+        with open(path, "rb") as f:
+            return types.Part.from_bytes(data=f.read(), mime_type=mime_type), None
+
+    remote_file = uploads.upload_file(client, path, mime_type, display_name=display_name, digest=key)
+    return uploads.as_part(remote_file), remote_file
+
+
+def upload_source(source_file):
+    """
+    Turn a spooled upload into the Part that is reused by every request in the session.
+
+    :param source_file: Dict with the "path", "mime_type", "name" and content "key" of the file to send,
+                        plus any labelled "attachments" for files sent as several parts.
+    :return: A (part, remote_files) tuple. The part references the file (file mode) or carries its
+             bytes (inline mode), or is a list of Parts (the file followed by its labelled attachments).
+    """
+    attachments = source_file.get("attachments") or []
+    payload = os.path.getsize(source_file["path"]) + sum(os.path.getsize(a["path"]) for a in attachments)
+    inline = UPLOAD_MODE == "inline" and payload <= INLINE_MAX_BYTES
+
+    part, remote_file = upload_part(
+        source_file["path"], source_file["mime_type"], source_file["name"], source_file["key"], inline
+    )
+    if not attachments:
+        return part, [remote_file] if remote_file else []
+
+    # Upload the attachments in parallel, each one is small but there can be a hundred of them
+    def upload_attachment(attachment):
+        key = uploads.file_digest(attachment["path"])
+        return upload_part(attachment["path"], attachment["mime_type"], source_file["name"], key, inline)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        attachment_parts = list(pool.map(upload_attachment, attachments))
+
+    parts = [part]
+    remote_files = [remote_file]
+    for attachment, (attachment_part, attachment_remote_file) in zip(attachments, attachment_parts):
+        parts.append(types.Part.from_text(text=attachment["label"]))
+        parts.append(attachment_part)
+        remote_files.append(attachment_remote_file)
+    return parts, [r for r in remote_files if r]
+
+
+def upload_material(source_file):
+    """
+    Upload a preprocessed file and its segments (for long material) and keep their Parts in the workflow state.
+
+    :param source_file: Dict describing the file to send, with any "segments" from preprocess.split_segments.
+    """
+    segments = source_file.get("segments") or []
+    part, remote_files = upload_source(source_file)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+        segment_uploads = list(pool.map(upload_source, segments))
+
+    state().uploaded_file_ref = part
+    state().segments = [
+        {"part": segment_part, "timeline": segment.get("timeline"), "label": segment["label"]}
+        for segment, (segment_part, _) in zip(segments, segment_uploads)
+    ]
+    state().remote_files = remote_files + [
+        remote_file for _, segment_files in segment_uploads for remote_file in segment_files
+    ]
+
+
+def refresh_file_ref(force=False):
+    """
+    Upload the current file (and its segments) again if a remote copy has expired.
+
+    :param force: Upload again even if the remote copies look valid (e.g. one was reported missing).
+    :return: The Part (or list of Parts) to use for the uploaded file.
+    """
+    remote_files = state().remote_files
+    source_file = state().source_file
+    if not remote_files or source_file is None:
+        return state().uploaded_file_ref
+
+    # Spooled files are shared between sessions, mark them as in use so they are not swept
+    files = [source_file, *(source_file.get("segments") or [])]
+    for file in files:
+        for attachment in file.get("attachments") or []:
+            preprocess.reuse_output(attachment["path"])
+    if not all([preprocess.reuse_output(file["path"]) for file in files]):
+        return state().uploaded_file_ref
+    if force or any(uploads.is_expired(remote_file) for remote_file in remote_files):
+        upload_material(source_file)
+    return state().uploaded_file_ref
+
+
+def run_preflight(source_file):
+    """
+    Count the tokens of the uploaded material and of every prompt, project the cost and duration of
+    the workflow, and downgrade it step by step while it is over budget (see WORKFLOW_BUDGET_USD).
+
+    The downgrades are, in order: lower media resolution for images and video frames, sending a
+    transcript instead of the recording, and analysing only a sample of the segments of long material.
+    The result is kept in st.session_state.preflight.
+
+    :param source_file: Dict describing the uploaded file, its "segments" are reduced when sampling.
+    """
+    is_recording = source_file["mime_type"].startswith(("audio/", "video/"))
+
+    prompts = {
+        "transcript": TRANSCRIPT_PROMPT,
+        "concept_map": SUMMARY_PROMPT,
+        "flashcards": FLASHCARD_PROMPT,
+        "first_question": FIRST_QUESTION_PROMPT,
+        "concept_map_merge": CONCEPT_MAP_REDUCE_PROMPT,
+        "flashcards_merge": FLASHCARD_REDUCE_PROMPT,
+    }
+    material = st.session_state.uploaded_file_ref
+    counts = get_event_loop().run_all([
+        client.aio.models.count_tokens(model=DEFAULT_MODEL, contents=contents)
+        for contents in [material if isinstance(material, list) else [material]] + [[p] for p in prompts.values()]
+    ])
+    failed = next((count for count in counts if isinstance(count, BaseException)), None)
+    if failed is not None:
+        logger.warning("Token count failed: %s", failed)
+        return
+    payload_tokens = counts[0].total_tokens
+    prompt_tokens = {task: count.total_tokens for task, count in zip(prompts, counts[1:])}
+
+    router = get_router()
+    models = {task: router.choose(task, record=False) for task in ("transcript", *preflight.OUTPUT_TOKENS)}
+    duration = preprocess.probe_duration(source_file["path"]) if is_recording and preprocess.FFMPEG else None
+    frames = preflight.media_frames(source_file, duration)
+    segments = len(st.session_state.segments)
+    plan = {"low_resolution": False, "transcribe": st.session_state.transcribe, "segments": segments}
+
+    def evaluate():
+        payload = payload_tokens
+        if plan["low_resolution"]:
+            payload -= frames * (preflight.IMAGE_TOKENS - preflight.LOW_RESOLUTION_IMAGE_TOKENS)
+        transcript_tokens = None
+        if plan["transcribe"]:
+            # Without a duration, assume the transcript is a tenth of the size of the audio
+            transcript_tokens = duration * preflight.TRANSCRIPT_TOKENS_PER_SECOND if duration else payload // 10
+        steps = preflight.plan_steps(
+            payload, prompt_tokens, transcript_tokens, plan["segments"], plan["segments"] / segments if segments else 1.0
+        )
+        estimate = preflight.project(steps, models)
+        estimate["context_tokens"] = transcript_tokens if transcript_tokens is not None else payload
+        estimate["within_budget"] = (
+            (estimate["cost"] is None or estimate["cost"] <= WORKFLOW_BUDGET_USD)
+            and estimate["request_tokens"] <= REQUEST_TOKEN_BUDGET
+        )
+        return estimate
+
+    downgrades = []
+    estimate = evaluate()
+    if not estimate["within_budget"] and frames:
+        plan["low_resolution"] = True
+        downgrades.append("lower media resolution")
+        estimate = evaluate()
+    if not estimate["within_budget"] and is_recording and not plan["transcribe"]:
+        plan["transcribe"] = True
+        downgrades.append("a transcript instead of the recording")
+        estimate = evaluate()
+    if not estimate["within_budget"] and segments > 1 and not plan["transcribe"]:
+        for keep in range(segments - 1, 0, -1):
+            plan["segments"] = keep
+            estimate = evaluate()
+            if estimate["within_budget"]:
+                break
+        downgrades.append(f"{plan['segments']} of {segments} evenly spaced segments")
+
+    if plan["low_resolution"]:
+        st.session_state.media_resolution = types.MediaResolution.MEDIA_RESOLUTION_LOW
+    st.session_state.transcribe = plan["transcribe"]
+    if plan["segments"] < segments:
+        keep = preflight.sample_segments(segments, plan["segments"])
+        st.session_state.segments = [st.session_state.segments[i] for i in keep]
+        source_file["segments"] = [source_file["segments"][i] for i in keep]
+
+    answer_cost = routing.cost(
+        models["grading"], estimate["context_tokens"] + preflight.OUTPUT_TOKENS["grading"] * 4,
+        preflight.OUTPUT_TOKENS["grading"]
+    )
+    st.session_state.preflight = {
+        **estimate, "payload_tokens": payload_tokens, "downgrades": downgrades, "answer_cost": answer_cost,
+        # Segments split the material evenly, each one is sent with its share of the payload
+        "segment_tokens": payload_tokens // segments if segments else None
+    }
+    logger.info(
+        "Preflight for %s: %s input tokens, cost %s, %.0fs, downgrades: %s",
+        source_file["name"], estimate["input_tokens"], estimate["cost"], estimate["seconds"], downgrades
+    )
+
+
+def generation_config(schema=None):
+    """
+    Build the request config for the current material (e.g. a lower media resolution chosen by the preflight).
+
+    :param schema: Optional pydantic model the response must be JSON for (see artifacts).
+    :return: The types.GenerateContentConfig, or None for the defaults.
+    """
+    options = {}
+    if state().media_resolution:
+        options["media_resolution"] = state().media_resolution
+    if schema is not None:
+        options["response_mime_type"] = "application/json"
+        options["response_schema"] = schema
+    return types.GenerateContentConfig(**options) if options else None
+
+
+def reset_session():
+    """
+    Clear every per-file session state variable.
+
+    The remote copy of the file is left to expire on its own since other sessions may be using it.
+    """
+    st.session_state.uploaded_file_ref = None
+    st.session_state.remote_files = []
+    st.session_state.segments = []
+    st.session_state.source_file = None
+    st.session_state.preprocess_report = []
+    st.session_state.transcript = None
+    st.session_state.workflow_status = "idle"
+    st.session_state.concept_map = None
+    st.session_state.flashcards = None
+    st.session_state.quiz_history = []
+    st.session_state.artifact_errors = {}
+    st.session_state.preflight = None
+    st.session_state.transcribe = False
+    st.session_state.media_resolution = None
+    st.session_state.job_id = None
+    st.query_params.pop("job", None)
+
+
+def context_part():
+    """
+    Get the Part that gives the model the uploaded material: the transcript once one exists,
+    otherwise the uploaded file itself.
+
+    :return: The Part to send along with prompts about the uploaded file.
+    """
+    if state().transcript:
+        return transcript_part(state().transcript)
+    return state().uploaded_file_ref
+
+
+def transcript_part(transcript):
+    """
+    :param transcript: The transcript text.
+    :return: The Part sending the transcript in place of the recording.
+    """
+    return types.Part.from_text(text=f"Transcript of the uploaded lecture:\n{transcript}")
+
 
 # Gemini Caller
-def generate(prompt, content_part=None, model="gemini-2.0-flash"):
+def build_contents(prompt, content_part=None):
+    """
+    Build the request contents from a prompt and the optional uploaded material.
+
+    :param prompt: The text prompt.
+    :param content_part: A Part or list of Parts for additional context.
+    :return: The list of contents to send.
+    """
+    contents = [prompt]
+    if isinstance(content_part, list):
+        contents.extend(content_part)
+    elif content_part:
+        contents.append(content_part)
+    return contents
+
+
+def estimate_tokens(prompt, content_part=None):
+    """
+    Estimate the input tokens of a request for the rate limiter: the preflight count for the uploaded
+    material (or its share of it for a segment), about four characters per token for text, and one
+    image for any other Part.
+
+    :param prompt: The text prompt.
+    :param content_part: The Part or list of Parts sent along with the prompt.
+    :return: The estimated number of input tokens.
+    """
+    tokens = len(prompt) // 4
+    if content_part is None:
+        return tokens
+    if content_part is state().uploaded_file_ref and state().preflight:
+        return tokens + state().preflight["payload_tokens"]
+    segment_tokens = (state().preflight or {}).get("segment_tokens")
+    if segment_tokens and any(content_part is segment["part"] for segment in state().segments):
+        return tokens + segment_tokens
+    for part in content_part if isinstance(content_part, list) else [content_part]:
+        if isinstance(part, str):
+            tokens += len(part) // 4
+        elif part.text:
+            tokens += len(part.text) // 4
+        else:
+            tokens += preflight.IMAGE_TOKENS
+    return tokens
+
+
+def hedge_delay(call_metrics, task, model, kind):
+    """
+    Decide how long a call may run before a duplicate request is sent (see HEDGE_REQUESTS).
+
+    The threshold comes from the latency of single attempts of the same task and model, without
+    rate limiter waits or retries. Streamed calls are compared (and hedged) up to their first chunk.
+
+    :param call_metrics: The Metrics holding the recent attempt latencies.
+    :param task: The workflow task of the call.
+    :param model: The model of the call.
+    :param kind: "response" for a whole response, "first_chunk" for the first chunk of a stream.
+    :return: The delay in seconds, or None if the call should not be hedged.
+    """
+    if not HEDGE_REQUESTS:
+        return None
+    threshold = call_metrics.percentile(
+        "gemini_attempt_seconds", HEDGE_PERCENTILE, min_samples=HEDGE_MIN_SAMPLES, task=task, model=model, kind=kind
+    )
+    if threshold is None:
+        return None
+    return max(threshold, HEDGE_MIN_DELAY)
+
+
+async def generate_async(prompt, content_part, model, router, task, config=None, tokens=0):
+    """
+    Send a single request through the SDK's async client, retrying transient failures (see RETRY_POLICY),
+    hedging slow attempts (see HEDGE_REQUESTS) and failing fast while the model's circuit breaker is open.
+    Every attempt first waits for its turn in the model's rate limiter (see RATE_LIMIT_RPM).
+
+    This runs on the shared event loop, outside the script thread, so it must not use the session state.
+
+    :param prompt: The text prompt for generating content.
+    :param content_part: The Part, or list of Parts, for additional context.
+    :param model: The model to use for content generation.
+    :param router: The Router recording latency and cost, its metrics also receive retry counts and delays.
+    :param task: The workflow task the call belongs to.
+    :param config: Optional types.GenerateContentConfig for the request.
+    :param tokens: Estimated input tokens of the request, see estimate_tokens.
+    :return: The generated content text.
+    :raises resilience.GenerationError: If the call failed for good.
+    """
+    call_metrics = router.metrics
+    limiter = router.limiter(model)
+    start = time.monotonic()
+    delay = hedge_delay(call_metrics, task, model, "response")
+
+    async def attempt():
+        await limiter.acquire(tokens)
+        copies = 0
+
+        async def send():
+            nonlocal copies
+            copies += 1
+            if copies > 1:
+                # A hedged duplicate goes out right away, but still uses up quota
+                limiter.debit(tokens, requests=1)
+            sent = time.monotonic()
+            response = await client.aio.models.generate_content(
+                model=model,
+                contents=build_contents(prompt, content_part),
+                config=config
+            )
+            call_metrics.observe(
+                "gemini_attempt_seconds", time.monotonic() - sent, task=task, model=model, kind="response"
+            )
+            return response
+
+        return await resilience.hedge(send, delay, call_metrics, model=model)
+
+    response = await RETRY_POLICY.call(attempt, call_metrics, breaker=router.breaker(model), model=model)
+    elapsed = time.monotonic() - start
+    call_metrics.observe("gemini_request_seconds", elapsed, model=model)
+    router.record(task, model, elapsed, response.usage_metadata)
+    if response.usage_metadata and response.usage_metadata.prompt_token_count:
+        limiter.debit(response.usage_metadata.prompt_token_count - tokens)
+    return response.text
+
+
+async def stream_async(prompt, content_part, model, router, task, config=None, tokens=0):
+    """
+    Stream a single request through the SDK's async client, yielding the text chunks as they arrive.
+
+    Failures before the first chunk are retried and slow first chunks hedged like in generate_async,
+    failures in the middle of the response are raised. Runs on the shared event loop, so it must not use the session state.
+
+    :param prompt: The text prompt for generating content.
+    :param content_part: The Part, or list of Parts, for additional context.
+    :param model: The model to use for content generation.
+    :param router: The Router recording latency and cost, its metrics also receive retry counts and
+                   the time to first token.
+    :param task: The workflow task the call belongs to.
+    :param config: Optional types.GenerateContentConfig for the request.
+    :param tokens: Estimated input tokens of the request, see estimate_tokens.
+    :return: An async iterator of text chunks.
+    :raises resilience.GenerationError: If the call failed.
+    """
+    call_metrics = router.metrics
+    limiter = router.limiter(model)
+    start = time.monotonic()
+    delay = hedge_delay(call_metrics, task, model, "first_chunk")
+
+    async def close(opened):
+        await opened[0].aclose()
+
+    async def open_stream():
+        await limiter.acquire(tokens)
+        copies = 0
+
+        # Only opening the stream is hedged, nothing has been shown before the first chunk
+        async def send():
+            nonlocal copies
+            copies += 1
+            if copies > 1:
+                limiter.debit(tokens, requests=1)
+            sent = time.monotonic()
+            stream = await client.aio.models.generate_content_stream(
+                model=model,
+                contents=build_contents(prompt, content_part),
+                config=config
+            )
+            try:
+                chunk = await anext(stream, None)
+            except BaseException:
+                await stream.aclose()
+                raise
+            call_metrics.observe(
+                "gemini_attempt_seconds", time.monotonic() - sent, task=task, model=model, kind="first_chunk"
+            )
+            return stream, chunk
+
+        return await resilience.hedge(send, delay, call_metrics, discard=close, model=model)
+
+    stream, chunk = await RETRY_POLICY.call(open_stream, call_metrics, breaker=router.breaker(model), model=model)
+    call_metrics.observe("gemini_time_to_first_token_seconds", time.monotonic() - start, model=model)
+    usage = None
+    try:
+        while chunk is not None:
+            # The usage is reported with the last chunk
+            usage = chunk.usage_metadata or usage
+            if chunk.text:
+                yield chunk.text
+            chunk = await anext(stream, None)
+    except Exception as e:
+        raise resilience.classify(e) from e
+    finally:
+        await stream.aclose()
+    elapsed = time.monotonic() - start
+    call_metrics.observe("gemini_request_seconds", elapsed, model=model)
+    router.record(task, model, elapsed, usage)
+    if usage and usage.prompt_token_count:
+        limiter.debit(usage.prompt_token_count - tokens)
+
+
+def generate_many(requests, model=None, task="other", schema=None):
+    """
+    Call Gemini API for several prompts concurrently on the shared event loop and wait for all of them.
+
+    :param requests: A list of (prompt, content_part, timeline) tuples, see generate.
+    :param model: The model to use for content generation, chosen by the router for the task if not given.
+    :param task: The workflow task the requests belong to (see routing.Router).
+    :param schema: Optional pydantic model the responses must be JSON for (see artifacts).
+    :return: The generated content texts, in request order.
+    :raises resilience.GenerationError: If any of the requests failed.
+    """
+    if not client:
+        raise resilience.GenerationError("An API Key is required.")
+    router = get_router()
+    model = model or router.choose(task)
+    config = generation_config(schema)
+    file_ref = state().uploaded_file_ref
+    is_file_ref = [part is not None and part is file_ref for _, part, _ in requests]
+    tokens = [estimate_tokens(prompt, part) for prompt, part, _ in requests]
+    try:
+        if any(is_file_ref):
+            file_ref = refresh_file_ref()
+
+        def run(indexes):
+            return get_event_loop().run_all([
+                generate_async(
+                    requests[i][0], file_ref if is_file_ref[i] else requests[i][1], model, router, task, config,
+                    tokens[i]
+                )
+                for i in indexes
+            ])
+
+        results = run(range(len(requests)))
+
+        # The remote file was deleted or expired early, upload it again and retry those requests once
+        missing = [
+            i for i, result in enumerate(results)
+            if is_file_ref[i] and isinstance(result, resilience.GenerationError) and result.status in (403, 404)
+        ]
+        if missing and state().remote_files:
+            file_ref = refresh_file_ref(force=True)
+            for i, result in zip(missing, run(missing)):
+                results[i] = result
+    except Exception as e:
+        # Uploading the file again failed
+        raise resilience.classify(e) from e
+
+    texts = []
+    for (_, _, timeline), from_file, result in zip(requests, is_file_ref, results):
+        if isinstance(result, BaseException):
+            raise resilience.classify(result) from result
+        # The model saw the trimmed recording, point any timestamps back at the original
+        if from_file and timeline is None:
+            timeline = (state().source_file or {}).get("timeline")
+        texts.append(preprocess.remap_timestamps(result, timeline) if timeline and result else result)
+    return texts
+
+
+def generate(prompt, content_part=None, model=None, timeline=None, task="other", schema=None):
     """
     Call Gemini API to generate content based on the prompt and provided file data.
     
     :param prompt: The text prompt for generating content.
-    :param content_part: The file data bytes for additional context.
+    :param content_part: The Part (file reference or inline bytes), or list of Parts, for additional context.
+    :param model: The model to use for content generation, chosen by the router for the task if not given.
+    :param timeline: Timeline of a trimmed or segmented recording in content_part, used to map timestamps
+                     in the response back to the original (defaults to the uploaded file's timeline).
+    :param task: The workflow task the request belongs to (see routing.Router).
+    :param schema: Optional pydantic model the response must be JSON for (see artifacts).
+    :return: The generated content text.
+    :raises resilience.GenerationError: If the request failed, after retrying transient errors.
+    """
+    return generate_many([(prompt, content_part, timeline)], model, task, schema)[0]
+
+
+def generate_stream(prompt, content_part=None, model=None, timeline=None, task="other", schema=None):
+    """
+    Call Gemini API like generate, but yield the response while it is being generated.
+
+    :param prompt: The text prompt for generating content.
+    :param content_part: The Part (file reference or inline bytes), or list of Parts, for additional context.
+    :param model: The model to use for content generation, chosen by the router for the task if not given.
+    :param timeline: Timeline of a trimmed or segmented recording in content_part, see generate.
+    :param task: The workflow task the request belongs to (see routing.Router).
+    :param schema: Optional pydantic model the response must be JSON for (see artifacts).
+    :return: An iterator of the response text received so far, growing with every chunk.
+    :raises resilience.GenerationError: If the request failed, after retrying transient errors.
+    """
+    if not client:
+        raise resilience.GenerationError("An API Key is required.")
+    router = get_router()
+    model = model or router.choose(task)
+    config = generation_config(schema)
+    is_file_ref = content_part is not None and content_part is state().uploaded_file_ref
+    tokens = estimate_tokens(prompt, content_part)
+    try:
+        if is_file_ref:
+            content_part = refresh_file_ref()
+            if timeline is None:
+                timeline = (state().source_file or {}).get("timeline")
+    except Exception as e:
+        raise resilience.classify(e) from e
+
+    def stream(part):
+        text = ""
+        for chunk in get_event_loop().iterate(stream_async(prompt, part, model, router, task, config, tokens)):
+            text += chunk
+            # The model saw the trimmed recording, point any timestamps back at the original
+            yield preprocess.remap_timestamps(text, timeline) if timeline else text
+
+    received = False
+    try:
+        for text in stream(content_part):
+            received = True
+            yield text
+    except resilience.GenerationError as e:
+        # The remote file was deleted or expired early, upload it again and retry once
+        if received or not (is_file_ref and e.status in (403, 404) and state().remote_files):
+            raise
+        try:
+            content_part = refresh_file_ref(force=True)
+        except Exception as upload_error:
+            raise resilience.classify(upload_error) from upload_error
+        yield from stream(content_part)
+
+
+def stream_into(placeholder, texts, render=None):
+    """
+    Render a response into a placeholder while it is being generated.
+
+    :param placeholder: The st.empty placeholder to render into.
+    :param texts: Iterator of the response text received so far, as returned by generate_stream.
+    :param render: Optional function turning the text received so far into Markdown (e.g. for JSON responses).
+    :return: The complete response text.
+    """
+    text = ""
+    for text in texts:
+        placeholder.markdown(render(text) if render else text)
+    return text
+
+
+def prompt_version(prompt):
+    """
+    Version a prompt template by its content, so editing a prompt invalidates its cached results.
+
+    :param prompt: The prompt template text.
+    :return: A short hash of the prompt.
+    """
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:12]
+
+
+def generate_segmented(prompt, model, task, placeholder=None, schema=None, render=None):
+    """
+    Generate an artifact for long material by running the prompt over every segment in parallel
+    (map) and merging the results with a single text-only call (reduce).
+
+    Transcripts are simply concatenated since every segment already maps its timestamps back to
+    the original recording.
+
+    :param prompt: The prompt template for the artifact.
+    :param model: The model to use for content generation.
+    :param task: The workflow task the artifact belongs to.
+    :param placeholder: Optional st.empty placeholder the merged result is streamed into.
+    :param schema: Optional pydantic model the segment results and the merged result must be JSON for.
+    :param render: Optional function turning the streamed text into Markdown, see stream_into.
+    :return: The generated content text.
+    :raises resilience.GenerationError: If any of the calls failed.
+    """
+    refresh_file_ref()
+    segments = state().segments
+
+    results = generate_many([
+        (f"The attached material is {segment['label']}.\n{prompt}", segment["part"], segment["timeline"])
+        for segment in segments
+    ], model, task, schema)
+    if prompt == TRANSCRIPT_PROMPT:
+        return "\n\n".join(results)
+
+    merged = "\n\n".join(
+        f"### Results for {segment['label']}\n{result}" for segment, result in zip(segments, results)
+    )
+    reduce_prompt = f"{SEGMENT_REDUCE_PROMPTS[prompt]}\n{merged}"
+    if placeholder is not None:
+        return stream_into(placeholder, generate_stream(reduce_prompt, model=model, task=task, schema=schema), render)
+    return generate(reduce_prompt, model=model, task=task, schema=schema)
+
+
+def validate_artifact(schema, text, model, task):
+    """
+    Validate a structured artifact, asking the model once to repair it if it doesn't match its schema.
+
+    The repair is a text-only call with the invalid response, the material is not sent again.
+
+    :param schema: The pydantic model the response must match (see artifacts).
+    :param text: The JSON text returned by the model.
+    :param model: The model that generated it, also used for the repair.
+    :param task: The workflow task the artifact belongs to.
+    :return: The validated instance of schema.
+    :raises resilience.GenerationError: If the response is still invalid after the repair.
+    """
+    try:
+        return artifacts.parse(schema, text)
+    except pydantic.ValidationError as e:
+        logger.warning("The %s response failed validation, asking for a repair: %s", task, e)
+        get_metrics().increment("artifact_repairs_total", task=task)
+        repaired = generate(REPAIR_PROMPT.format(error=e, response=text), model=model, task=task, schema=schema)
+    try:
+        return artifacts.parse(schema, repaired)
+    except pydantic.ValidationError as e:
+        get_metrics().increment("artifact_invalid_total", task=task)
+        raise resilience.GenerationError(
+            f"The {task.replace('_', ' ')} returned by the model was malformed, even after a repair attempt."
+        ) from e
+
+
+def generate_artifact(prompt, task, model, material, transcript=None, placeholder=None, schema=None):
+    """
+    Generate a workflow artifact from the uploaded material, or from its transcript if there is one.
+
+    Long material is processed segment by segment (see generate_segmented) unless the transcript
+    is used instead of the recording.
+
+    Structured artifacts are generated as JSON constrained to their schema and validated (see
+    validate_artifact).
+
+    :param prompt: The prompt template for the artifact.
+    :param task: The workflow task the artifact belongs to (see routing.Router).
     :param model: The model to use for content generation.
-    :return: The generated content text or an error message if an exception occurs.
+    :param material: The output of the preprocess node, see prepare_material.
+    :param transcript: Optional transcript to send in place of the recording.
+    :param placeholder: Optional st.empty placeholder the result is streamed into.
+    :param schema: Optional pydantic model of a structured artifact (see artifacts).
+    :return: The generated content text, or the validated JSON text for structured artifacts.
+    :raises resilience.GenerationError: If the artifact could not be generated.
+    """
+    segmented = (
+        material["segments"]
+        and not transcript
+        and (prompt in SEGMENT_REDUCE_PROMPTS or prompt == TRANSCRIPT_PROMPT)
+    )
+    content_part = transcript_part(transcript) if transcript else material["part"]
+    renderer = artifacts.RENDERERS.get(schema)
+    render = (lambda text: renderer(artifacts.parse_partial(text))) if renderer else None
+
+    if segmented:
+        text = generate_segmented(prompt, model, task, placeholder, schema, render)
+    elif placeholder is not None:
+        texts = generate_stream(prompt, content_part, model, task=task, schema=schema)
+        text = stream_into(placeholder, texts, render)
+    else:
+        text = generate(prompt, content_part, model, task=task, schema=schema)
+    if schema is None:
+        return text
+    return validate_artifact(schema, text, model, task).model_dump_json()
+
+
+def run_step(name, function, **kwargs):
+    """
+    Run a workflow step, recording a failure for the dashboard instead of raising it.
+
+    :param name: The workflow task, also the name of the artifact in the artifact_errors of the workflow state.
+    :param function: The function generating the artifact, e.g. generate_artifact.
+    :param kwargs: Keyword arguments for function.
+    :return: What function returned, or None if it failed.
     """
-    if not client: return "Error: No API Key"
     try:
-        contents = [prompt]
-        if content_part:
-            contents.append(content_part)
-        
-        response = client.models.generate_content(
-            model=model,
-            contents=contents
+        result = function(**kwargs)
+    except resilience.GenerationError as e:
+        logger.warning("Generating %s failed after %d attempt(s): %s", name, e.attempts, e)
+        state().artifact_errors[name] = str(e)
+        return None
+    state().artifact_errors.pop(name, None)
+    return result
+
+
+def bind_context(function):
+    """
+    Wrap a function to run in a worker thread attached to the current session (or background job),
+    so it can use the workflow state and render into placeholders.
+
+    :param function: The function to wrap, called from the thread that will hand it to the worker.
+    :return: The wrapped function.
+    """
+    ctx = get_script_run_ctx(suppress_warning=True)
+    current = getattr(job_state, "value", None)
+
+    def attached(*args, **kwargs):
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        job_state.value = current
+        return function(*args, **kwargs)
+
+    return attached
+
+
+# Status line of every workflow step while it is running, once it is done and if it failed
+STEP_MESSAGES = {
+    "transcript": {
+        "running": "**Transcription Agent:** Transcribing the recording...",
+        "done": "**Transcription Agent:** Transcript ready.",
+        "failed": "**Transcription Agent:** Transcription failed, the recording will be used directly.",
+    },
+    "concept_map": {
+        "running": "**Analysis Agent:** Reading content and generating a Concept Map...",
+        "done": "**Analysis Agent:** Concept Map generated.",
+        "failed": "**Analysis Agent:** Concept Map failed.",
+    },
+    "flashcards": {
+        "running": "**Flashcard Agent:** Extracting key terms for Flashcards...",
+        "done": "**Flashcard Agent:** Flashcards created.",
+        "failed": "**Flashcard Agent:** Flashcards failed.",
+    },
+    "first_question": {
+        "running": "**Quiz Agent:** Priming quiz engine...",
+        "done": "**Quiz Agent:** Tutor ready.",
+        "failed": "**Quiz Agent:** Quiz failed.",
+    },
+}
+
+# Structured artifacts of the workflow by step, the others are plain text
+STEP_SCHEMAS = {
+    "concept_map": artifacts.ConceptMap,
+    "flashcards": artifacts.FlashcardDeck,
+}
+
+
+def prepare_material(file, media_resolution, segments):
+    """
+    The preprocess node of the workflow. The material was preprocessed and uploaded as soon as it
+    was added (the preflight estimate needs it before launch), this makes sure the remote copies
+    are still available. Its params identify the material, so every result downstream is cached
+    per file, media resolution and segmentation.
+
+    :param file: Content key of the preprocessed file.
+    :param media_resolution: The media resolution the material is sent with.
+    :param segments: Number of segments of long material.
+    :return: Dict with the "part" (Part or list of Parts) to send and the "segments" of long material.
+    """
+    return {"part": refresh_file_ref(), "segments": state().segments}
+
+
+def artifact_node(name, prompt, inputs, placeholder=None):
+    """
+    Declare a workflow node generating an artifact with the model the router chooses for it.
+
+    :param name: The workflow task, also the name of the node.
+    :param prompt: The prompt template for the artifact.
+    :param inputs: Names of the nodes it reads: "preprocess" and optionally "transcript".
+    :param placeholder: Optional st.empty placeholder (or jobs.JobSlot) the result is streamed into.
+    :return: The pipeline.Node.
+    """
+    schema = STEP_SCHEMAS.get(name)
+
+    def node_params():
+        reduce_prompt = SEGMENT_REDUCE_PROMPTS.get(prompt, "")
+        return {
+            "prompt": prompt_version(prompt),
+            "reduce_prompt": prompt_version(reduce_prompt),
+            "schema": prompt_version(json.dumps(schema.model_json_schema(), sort_keys=True)) if schema else None,
+            # A fallback model produces (and caches) its own result
+            "model": get_router().choose(name),
+        }
+
+    def compute(preprocess, model, transcript=None, **params):
+        return run_step(
+            name, generate_artifact, prompt=prompt, task=name, model=model, material=preprocess,
+            transcript=transcript, placeholder=placeholder, schema=schema
         )
-        return response.text
-    except Exception as e:
-        return f"Error: {e}"
+
+    return pipeline.Node(name, compute, inputs, node_params)
+
+
+def workflow_pipeline(job):
+    """
+    Declare the agent workflow as a DAG: preprocess -> transcript -> concept map, flashcards and
+    first question. The transcript is only part of it for recordings that are transcribed.
+
+    :param job: The jobs.Job the concept map is streamed into.
+    :return: The pipeline.Pipeline.
+    """
+    current = state()
+    nodes = [
+        pipeline.Node(
+            "preprocess",
+            prepare_material,
+            params=lambda: {
+                "file": current.source_file["key"],
+                "media_resolution": str(current.media_resolution),
+                "segments": len(current.segments),
+            },
+            cacheable=False
+        )
+    ]
+    context = ("preprocess",)
+    if current.transcribe:
+        nodes.append(artifact_node("transcript", TRANSCRIPT_PROMPT, ("preprocess",)))
+        context += ("transcript",)
+    nodes += [
+        artifact_node("concept_map", SUMMARY_PROMPT, context, jobs.JobSlot(job, "concept_map")),
+        artifact_node("flashcards", FLASHCARD_PROMPT, context),
+        artifact_node("first_question", FIRST_QUESTION_PROMPT, context),
+    ]
+    return pipeline.Pipeline(nodes)
+
+
+def start_workflow(regenerate=()):
+    """
+    Submit the missing agent steps for the current material as a background job and attach this
+    session to it. The job id is kept in the URL so a refreshed page can attach to it again.
+
+    :param regenerate: Names of steps to generate again even though they have a result.
+    """
+    # Steps that already succeeded are kept when failed ones are retried. Without its transcript, a recording
+    # that is transcribed needs the transcript again, and the artifacts that fell back to the recording with it
+    # (a quiz that already started is kept)
+    retranscribe = st.session_state.transcribe and not st.session_state.transcript
+    targets = tuple(
+        name for name, missing in (
+            ("transcript", retranscribe),
+            ("concept_map", st.session_state.concept_map is None or retranscribe),
+            ("flashcards", st.session_state.flashcards is None or retranscribe),
+            ("first_question", not st.session_state.quiz_history),
+        )
+        if missing or name in regenerate
+    )
+    workflow = {
+        key: value.copy() if isinstance(value, (dict, list)) else value
+        for key, value in ((key, st.session_state[key]) for key in WORKFLOW_STATE_KEYS)
+    }
+    workflow["first_question"] = None
+    # Sessions working on the same material and steps with the same API key share one job instead of paying
+    # for the calls twice (the job runs with the client of the session that submitted it)
+    key = (
+        hashlib.sha256(api_key.encode("utf-8")).hexdigest(), st.session_state.current_file_digest, str(st.session_state.media_resolution),
+        st.session_state.transcribe, len(st.session_state.segments), targets, tuple(sorted(regenerate))
+    )
+    job = get_job_runner().submit(lambda job: run_workflow(job, targets, regenerate), workflow, key)
+    st.session_state.job_id = job.id
+    st.session_state.workflow_status = "processing"
+    st.query_params["job"] = job.id
+
+
+def run_workflow(job, targets, regenerate=()):
+    """
+    Run the agent steps that are still missing for the material (see workflow_pipeline) in a
+    background job.
+
+    Every step starts as soon as the steps it reads are done, and results already cached for the
+    same material, prompts and model are reused. Results are kept in job.state and the progress of
+    every step in the job, sessions poll them (see sync_job).
+
+    :param job: The jobs.Job, whose state is the copy of the workflow state it works on.
+    :param targets: Names of the steps to run.
+    :param regenerate: Names of steps to generate again, bypassing their cached result.
+    """
+    job_state.value = current = job.state
+    start = time.monotonic()
+    try:
+        values = {"transcript": current.transcript} if current.transcript else {}
+
+        def update(name, status, result):
+            if name == "preprocess":
+                if status == "failed":
+                    logger.warning("Preparing the material failed: %s", result)
+                return
+            if status == "failed":
+                # Errors from generation are recorded by run_step, this is anything else
+                current.artifact_errors.setdefault(name, str(result))
+            elif status != "running":
+                # A cached result also clears the error of an earlier attempt
+                if result:
+                    current.artifact_errors.pop(name, None)
+                if name == "transcript":
+                    current.transcript = result
+                elif name == "first_question":
+                    current.first_question = result
+                elif result:
+                    setattr(current, name, artifacts.parse(STEP_SCHEMAS[name], result))
+                status = "done" if result else "failed"
+            job.set_step(name, status)
+
+        workflow_pipeline(job).run(
+            targets, values, regenerate, get_result_cache(), bind_context, update
+        )
+        get_metrics().observe("workflow_seconds", time.monotonic() - start)
+    finally:
+        job_state.value = None
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_job_progress(job_id, version):
+    """
+    Show the progress of the background job, and rerun the whole page when a step has finished so
+    its result appears on the dashboard.
+
+    :param job_id: The id of the jobs.Job of this session.
+    :param version: The job version the page was rendered from.
+    """
+    job = get_job_runner().get(job_id)
+    if job is None or job.version != version:
+        st.rerun()
+
+    with st.status("Agent Orchestrating Workflow...", expanded=True):
+        for name, step_status in job.steps().items():
+            st.write(STEP_MESSAGES[name][step_status])
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_job_partial(job_id, name):
+    """
+    Show the result of a background job step while it is being streamed.
+
+    :param job_id: The id of the jobs.Job of this session.
+    :param name: The step whose result is streamed.
+    """
+    job = get_job_runner().get(job_id)
+    partial = job.partial(name) if job is not None else None
+    if partial:
+        st.markdown(partial)
+    else:
+        st.caption("Generating...")
 
 
 # Main UI
 
 st.markdown('<div class="main-header">🧠 The Student Assistant</div>', unsafe_allow_html=True)
 
+# Let users know right away when the model backend is down instead of after a timeout
+for breaker in get_router().open_breakers():
+    st.warning(
+        f"⚠️ {breaker.name} is having problems right now. Requests to it are paused and will resume in about "
+        f"{breaker.retry_in():.0f}s. Results you already have are not affected."
+    )
+
+if SHOW_METRICS:
+    with st.sidebar:
+        with st.expander("📊 Metrics", expanded=False):
+            st.json(get_metrics().snapshot())
+
+# A refreshed page attaches to its background job again, the job id is kept in the URL
+if st.session_state.job_id is None and "job" in st.query_params:
+    job = get_job_runner().get(st.query_params["job"])
+    if job is not None:
+        sync_job(job, restore=True)
+        st.session_state.job_id = job.id
+        st.session_state.workflow_status = "processing" if job.status == "running" else "done"
+    else:
+        st.query_params.pop("job", None)
+
 # Section for uploading lecture content to use for agentic workflow
 st.write("### 📂 Step 1: Upload Source Material")
 uploaded_file = st.file_uploader(
@@ -82,36 +1383,74 @@ uploaded_file = st.file_uploader(
     type=['pdf', 'txt', 'png', 'jpg', 'mp3', 'wav', 'mp4']
 )
 
+# Identify uploads by their content so renamed copies are not processed again
+# and different files that share a name are never confused
+# Spooling and hashing only happen once per upload, not on every rerun
+file_digest = st.session_state.current_file_digest
+spool_path = None
+if uploaded_file and uploaded_file.file_id != st.session_state.current_upload_id:
+    spool_path, file_digest = uploads.spool_upload(uploaded_file, SPOOL_DIR)
+
 # Handle new uploaded files
-if uploaded_file and uploaded_file.name != st.session_state.current_file_name:
+if uploaded_file and file_digest != st.session_state.current_file_digest:
     # Reset session state variables
-    st.session_state.uploaded_file_ref = None
-    st.session_state.workflow_status = "idle"
-    st.session_state.concept_map = None
-    st.session_state.flashcards_csv = None
-    st.session_state.quiz_history = []
+    reset_session()
 
     # Process the new file
     with st.spinner("Uploading and processing file..."):
         try:
-            file_bytes = uploaded_file.getvalue()
-            st.session_state.uploaded_file_ref = types.Part.from_bytes(
-                data=file_bytes,
-                mime_type=uploaded_file.type
+            if UPLOAD_MODE != "inline" and not client:
+                raise ValueError("An API Key is required to upload files.")
+            source_file = {
+                "path": spool_path,
+                "mime_type": uploaded_file.type,
+                "name": uploaded_file.name,
+                "key": file_digest
+            }
+            source_file, report = preprocess.prepare_upload(
+                source_file,
+                SPOOL_DIR,
+                transcode=TRANSCODE_AUDIO,
+                trim=TRIM_SILENCE,
+                decompose=DECOMPOSE_VIDEO,
+                pdf_text=PDF_TEXT,
+                shrink_images=SHRINK_IMAGES,
+                enhance_images=ENHANCE_IMAGES
             )
-            st.session_state.current_file_name = uploaded_file.name
+            if SEGMENT_LONG_MATERIAL:
+                source_file["segments"], segment_report = preprocess.split_segments(source_file, SPOOL_DIR)
+                report.extend(segment_report)
+            upload_material(source_file)
+            st.session_state.transcribe = TRANSCRIPT_MODE and uploaded_file.type.startswith(("audio/", "video/"))
+            if client:
+                run_preflight(source_file)
+            if uploaded_file.type.startswith("video/") and source_file.get("attachments"):
+                tokens = (st.session_state.preflight or {}).get("payload_tokens")
+                if tokens is not None:
+                    report.append(f"Video request payload: {tokens:,} tokens per call.")
+                logger.info(
+                    "Video %s sent as audio + %d frames, %s tokens per call",
+                    source_file["name"], len(source_file["attachments"]), tokens
+                )
+            st.session_state.source_file = source_file
+            st.session_state.preprocess_report = report
+            st.session_state.current_file_digest = file_digest
+            st.session_state.current_upload_id = uploaded_file.file_id
             st.rerun()
         except Exception as e:
             st.error(f"Error processing file: {e}")
 
+# Same content uploaded again (e.g. under a different name), keep the existing results
+elif uploaded_file:
+    st.session_state.current_upload_id = uploaded_file.file_id
+
 # Detect file removal and reset session state variables
-if not uploaded_file and st.session_state.uploaded_file_ref:
-    st.session_state.uploaded_file_ref = None
-    st.session_state.current_file_name = None
-    st.session_state.workflow_status = "idle"
-    st.session_state.concept_map = None
-    st.session_state.flashcards_csv = None
-    st.session_state.quiz_history = []
+# (a page that attached to its job after a refresh has the results but no upload)
+restored = st.session_state.job_id and st.session_state.current_upload_id is None
+if not uploaded_file and st.session_state.uploaded_file_ref and not restored:
+    reset_session()
+    st.session_state.current_file_digest = None
+    st.session_state.current_upload_id = None
     st.rerun()
 
 # After the user has uploaded a file...
@@ -120,55 +1459,54 @@ if st.session_state.uploaded_file_ref:
     # If workflow hasn't run yet, show the Launch Button
     if st.session_state.workflow_status == "idle":
         st.info("File uploaded successfully. Ready to analyze.")
+        for note in st.session_state.preprocess_report:
+            st.caption(note)
+        estimate = st.session_state.preflight
+        if estimate:
+            cost = f"${estimate['cost']:.3f}" if estimate["cost"] is not None else "an unknown cost"
+            answer_cost = f" Each quiz answer adds about ${estimate['answer_cost']:.4f}." if estimate["answer_cost"] else ""
+            st.caption(
+                f"Projected workflow: {estimate['input_tokens'] + estimate['output_tokens']:,} tokens for {cost}, "
+                f"about {estimate['seconds']:.0f}s.{answer_cost}"
+            )
+            if estimate["downgrades"]:
+                st.info("To stay within the budget, this material is analysed using " + ", ".join(estimate["downgrades"]) + ".")
+            if not estimate["within_budget"]:
+                st.warning("This material is over the budget even with every downgrade, some steps may fail.")
         if st.button("Launch Student Assistant Agent", type="primary"):
-            st.session_state.workflow_status = "processing"
+            start_workflow()
             st.rerun()
 
-    # If workflow is processing, run the sequential agent steps
-    elif st.session_state.workflow_status == "processing":
-        with st.status("Agent Orchestrating Workflow...", expanded=True) as status:
-            
-            # Step 1: Concept Map Synthesis
-            st.write("**Analysis Agent:** Reading content and generating a Concept Map...")
-            summary_prompt = """
-            Analyze the attached material deeply.
-            Create a 'Concept Map' Summary:
-            1. **Main Topic**: What is this primarily about?
-            2. **Core Concepts**: List the top 5-20 most important terms with definitions.
-            3. **The 'Aha!' Moment**: The most complex idea explained simply.
-            """
-            st.session_state.concept_map = generate(summary_prompt, st.session_state.uploaded_file_ref)
-            st.write("Concept Map generated.")
-            
-            # Step 2: Flashcard Generation
-            st.write("**Flashcard Agent:** Extracting key terms for Flashcards...")
-            flashcard_prompt = """
-            Create a CSV formatted list of flashcards from this content.
-            The flashcards should be useful for studying the main course content covered and not any unrelevant information.
-            Format: "Front","Back"
-            Generate 20 cards. No markdown code blocks and no escaping characters, just raw CSV.
-            """
-            st.session_state.flashcards_csv = generate(flashcard_prompt, st.session_state.uploaded_file_ref)
-            st.write("Flashcards created.")
-            
-            # Step 3: Quiz Initialization
-            st.write("**Quiz Agent:** Priming quiz engine...")
-            q1_prompt = """
-            You are a rigorous but fair tutor providing a practice quiz to a student. 
-            Ask me the first distinct question based on the uploaded file. Do not give the answer.
-            """
-            first_question = generate(q1_prompt, st.session_state.uploaded_file_ref)
-            st.session_state.quiz_history = [("assistant", first_question)]
-            st.write("Tutor ready.")
-            
-            status.update(label="Workflow Complete! Dashboard Ready.", state="complete", expanded=False)
-            
-            st.session_state.workflow_status = "done"
-            time.sleep(1)
-            st.rerun()
+    # While the workflow is processing in its background job, the dashboard is shown right away
+    # and every artifact appears in it as soon as its agent finishes
+    else:
+        if st.session_state.workflow_status == "processing":
+            job = get_job_runner().get(st.session_state.job_id) if st.session_state.job_id else None
+            if job is None:
+                # The job expired or the server restarted, start the missing steps again
+                start_workflow()
+                job = get_job_runner().get(st.session_state.job_id)
+            version = job.version
+            sync_job(job)
+            if job.status != "running":
+                if job.status == "failed":
+                    for name in ("concept_map", "flashcards"):
+                        if st.session_state[name] is None:
+                            st.session_state.artifact_errors.setdefault(name, job.error)
+                    if not st.session_state.quiz_history:
+                        st.session_state.artifact_errors.setdefault("first_question", job.error)
+                st.session_state.workflow_status = "done"
+        processing = st.session_state.workflow_status == "processing"
 
-    # Dashboard View
-    elif st.session_state.workflow_status == "done":
+        if processing:
+            show_job_progress(job.id, version)
+
+        # Failed steps show their error in place of the result and can be retried
+        elif st.session_state.artifact_errors:
+            st.warning("Some steps could not be completed. Nothing was lost, you can retry just those steps.")
+            if st.button("Retry failed steps"):
+                start_workflow()
+                st.rerun()
         
         # 2-column layout for Concept Map & Flashcards
         col1, col2 = st.columns([0.6, 0.4])
@@ -177,21 +1515,42 @@ if st.session_state.uploaded_file_ref:
             with st.container():
                 st.subheader("📖 Concept Map")
                 # Use expander so it doesn't dominate the page when unused
-                # Start with expander collapsed to avoid auto-scrolling to the bottom
-                with st.expander("View Summary Notes", expanded=False):
-                    st.markdown(st.session_state.concept_map)
+                # Start with expander collapsed to avoid auto-scrolling to the bottom, unless it is being streamed
+                streaming = processing and st.session_state.concept_map is None
+                with st.expander("View Summary Notes", expanded=streaming):
+                    if streaming:
+                        show_job_partial(job.id, "concept_map")
+                    elif st.session_state.concept_map:
+                        st.markdown(artifacts.render_concept_map(st.session_state.concept_map))
+                    else:
+                        st.error(st.session_state.artifact_errors.get("concept_map", "No Concept Map."))
+                if st.session_state.transcript:
+                    with st.expander("View Transcript", expanded=False):
+                        st.markdown(st.session_state.transcript)
                 st.markdown('</div>', unsafe_allow_html=True)
 
         with col2:
             with st.container():
                 st.subheader("⚡ Study Flashcards")
-                st.success(f"Generated 20 Flashcards")
-                st.download_button(
-                    label="Download Anki/CSV Deck",
-                    data=str(st.session_state.flashcards_csv),
-                    file_name="flashcards.csv",
-                    mime="text/csv"
-                )
+                if st.session_state.flashcards:
+                    st.success(f"Generated {len(st.session_state.flashcards.cards)} Flashcards")
+                    # Downloading doesn't need to rerun the page
+                    st.download_button(
+                        label="Download Anki/CSV Deck",
+                        data=artifacts.flashcards_csv(st.session_state.flashcards),
+                        file_name="flashcards.csv",
+                        mime="text/csv",
+                        on_click="ignore"
+                    )
+                    # Only the flashcard agent runs again, the other results are kept
+                    if not processing and st.button("Regenerate Flashcards"):
+                        st.session_state.flashcards = None
+                        start_workflow(regenerate=("flashcards",))
+                        st.rerun()
+                elif processing:
+                    st.caption("Generating...")
+                else:
+                    st.error(st.session_state.artifact_errors.get("flashcards", "No Flashcards."))
                 st.markdown('</div>', unsafe_allow_html=True)
 
         # Use full page width for the Interactive Quiz
@@ -205,26 +1564,37 @@ if st.session_state.uploaded_file_ref:
             for role, text in st.session_state.quiz_history:
                 with st.chat_message(role):
                     st.markdown(text)
+            if not st.session_state.quiz_history:
+                if processing:
+                    st.caption("Generating...")
+                else:
+                    st.error(st.session_state.artifact_errors.get("first_question", "The quiz could not be started."))
 
         # Input handling
-        if user_answer := st.chat_input("Answer the quiz question..."):
+        if user_answer := st.chat_input("Answer the quiz question...", disabled=not st.session_state.quiz_history):
             st.session_state.quiz_history.append(("user", user_answer))
             with st.chat_message("user"):
                 st.markdown(user_answer)
             
             with st.chat_message("assistant"):
-                with st.spinner("Grading..."):
-                    # Construct context for the grading agent
-                    history_text = "\n".join([f"{role}: {text}" for role, text in st.session_state.quiz_history])
-                    grading_prompt = f"""
-                    Context: The user is answering a quiz based on the uploaded file.
-                    History: {history_text}
-                    
-                    Task:
-                    1. Grade the user's last answer based strictly on the file.
-                    2. If wrong, explain why briefly.
-                    3. Ask the NEXT distinct question.
-                    """
-                    response = generate(grading_prompt, st.session_state.uploaded_file_ref)
-                    st.markdown(response)
+                response_placeholder = st.empty()
+                response_placeholder.caption("Grading...")
+                # Construct context for the grading agent
+                history_text = "\n".join([f"{role}: {text}" for role, text in st.session_state.quiz_history])
+                grading_prompt = f"""
+                Context: The user is answering a quiz based on the uploaded file.
+                History: {history_text}
+                
+                Task:
+                1. Grade the user's last answer based strictly on the file.
+                2. If wrong, explain why briefly.
+                3. Ask the NEXT distinct question.
+                """
+                try:
+                    response = stream_into(response_placeholder, generate_stream(grading_prompt, context_part(), task="grading"))
+                except resilience.GenerationError as e:
+                    # Drop the answer so it can simply be sent again
+                    st.session_state.quiz_history.pop()
+                    response_placeholder.error(f"{e}\n\nPlease send your answer again.")
+                else:
                     st.session_state.quiz_history.append(("assistant", response))
\ No newline at end of file
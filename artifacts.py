@@ -0,0 +1,99 @@
+import csv
+import io
+
+import pydantic
+import pydantic_core
+
+
+class Flashcard(pydantic.BaseModel):
+    """A single study card."""
+    front: str = pydantic.Field(min_length=1, description="The question or term on the front of the card.")
+    back: str = pydantic.Field(min_length=1, description="The answer or definition on the back of the card.")
+
+
+class FlashcardDeck(pydantic.BaseModel):
+    """The flashcards generated from the uploaded material."""
+    cards: list[Flashcard] = pydantic.Field(min_length=1)
+
+
+class Concept(pydantic.BaseModel):
+    """An important term of the material with its definition."""
+    term: str = pydantic.Field(min_length=1)
+    definition: str = pydantic.Field(min_length=1)
+
+
+class ConceptMap(pydantic.BaseModel):
+    """The 'Concept Map' summary of the uploaded material."""
+    main_topic: str = pydantic.Field(min_length=1, description="What the material is primarily about.")
+    core_concepts: list[Concept] = pydantic.Field(
+        min_length=1, description="The 5 to 20 most important terms with their definitions."
+    )
+    aha_moment: str = pydantic.Field(min_length=1, description="The most complex idea, explained simply.")
+
+
+def parse(schema, text):
+    """
+    Validate a JSON response against the model it was generated for.
+
+    :param schema: The pydantic model class, e.g. FlashcardDeck.
+    :param text: The JSON text returned by the model.
+    :return: The validated instance of schema.
+    :raises pydantic.ValidationError: If the text is not valid JSON or doesn't match the schema.
+    """
+    return schema.model_validate_json(text)
+
+
+def parse_partial(text):
+    """
+    Parse the beginning of a JSON response that is still being generated.
+
+    :param text: The JSON text received so far.
+    :return: A dict with the fields received so far (the last string may be incomplete).
+    """
+    try:
+        data = pydantic_core.from_json(text, allow_partial="trailing-strings")
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def render_concept_map(concept_map):
+    """
+    Render a concept map as Markdown.
+
+    :param concept_map: A ConceptMap, or a dict of the fields received so far while it is streamed.
+    :return: The Markdown text.
+    """
+    data = concept_map.model_dump() if isinstance(concept_map, ConceptMap) else concept_map
+    lines = []
+    if data.get("main_topic"):
+        lines.append(f"**Main Topic**: {data['main_topic']}\n")
+    concepts = [concept for concept in data.get("core_concepts") or [] if isinstance(concept, dict)]
+    if concepts:
+        lines.append("**Core Concepts**:\n")
+        for concept in concepts:
+            lines.append(f"- **{concept.get('term', '')}**: {concept.get('definition', '')}")
+        lines.append("")
+    if data.get("aha_moment"):
+        lines.append(f"**The 'Aha!' Moment**: {data['aha_moment']}")
+    return "\n".join(lines)
+
+
+# Markdown renderers of the artifacts that are streamed to the user while they are generated
+RENDERERS = {
+    ConceptMap: render_concept_map,
+}
+
+
+def flashcards_csv(deck):
+    """
+    Export flashcards as CSV that Anki and spreadsheets can import, one "Front","Back" row per card.
+
+    :param deck: The FlashcardDeck.
+    :return: The CSV text.
+    """
+    output = io.StringIO()
+    writer = csv.writer(output, quoting=csv.QUOTE_ALL, lineterminator="\n")
+    for card in deck.cards:
+        writer.writerow([card.front, card.back])
+    return output.getvalue()
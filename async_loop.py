@@ -0,0 +1,92 @@
+import asyncio
+import queue
+import threading
+
+
+class BackgroundLoop:
+    """
+    An asyncio event loop running forever in a daemon thread, shared by every session.
+
+    Script threads hand coroutines to the loop and wait for their results, so any number of
+    in-flight model calls share this one thread. The async HTTP connections opened by the SDK
+    belong to the loop that created them, which keeps them reusable from one call to the next.
+    """
+
+    def __init__(self, name="gemini-event-loop"):
+        """
+        :param name: Name of the thread running the loop.
+        """
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, coro):
+        """
+        Schedule a coroutine on the loop without waiting for it.
+
+        :param coro: The coroutine to run.
+        :return: A concurrent.futures.Future for its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """
+        Run a coroutine on the loop and block the calling thread until it finishes.
+
+        :param coro: The coroutine to run.
+        :param timeout: Optional number of seconds to wait before cancelling it.
+        :return: The result of the coroutine.
+        """
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            # Don't leave the call running when the caller gives up (timeout, script stopped, ...)
+            future.cancel()
+            raise
+
+    def run_all(self, coros, timeout=None):
+        """
+        Run several coroutines concurrently on the loop and wait for all of them.
+
+        :param coros: The coroutines to run.
+        :param timeout: Optional number of seconds to wait before cancelling them.
+        :return: The results in the order of the coroutines, with exceptions returned in place of
+                 the results of the ones that failed.
+        """
+        async def gather():
+            return await asyncio.gather(*coros, return_exceptions=True)
+
+        return self.run(gather(), timeout)
+
+    def iterate(self, aiterator):
+        """
+        Consume an async iterator on the loop, handing its items to the calling thread as they arrive.
+
+        :param aiterator: The async iterator (e.g. an async generator) to consume.
+        :return: A regular iterator over the same items. Exceptions raised by the async iterator
+                 are raised from it, and closing it early cancels the async iterator.
+        """
+        items = queue.Queue()
+        done = object()
+
+        async def pump():
+            try:
+                async for item in aiterator:
+                    items.put((item, None))
+            except Exception as e:
+                items.put((done, e))
+            else:
+                items.put((done, None))
+
+        future = self.submit(pump())
+        try:
+            while True:
+                item, error = items.get()
+                if error is not None:
+                    raise error
+                if item is done:
+                    return
+                yield item
+        finally:
+            future.cancel()
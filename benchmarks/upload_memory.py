@@ -0,0 +1,92 @@
+"""
+Benchmark the peak memory used to prepare a single upload.
+
+Each pipeline runs in a fresh subprocess with a synthetic upload held in memory (like
+Streamlit's UploadedFile) and reports how much the peak RSS grew beyond that copy.
+
+Usage: python benchmarks/upload_memory.py [size_mb]
+"""
+import io
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from google.genai import types  # noqa: E402
+import uploads  # noqa: E402
+
+# The SDK streams uploads in blocks of this size
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def read_status_kb(field):
+    """
+    Read a memory counter of the current process from /proc (Linux only).
+
+    :param field: The counter name, e.g. "VmRSS" (current) or "VmHWM" (peak).
+    :return: The counter value in KiB.
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def reset_peak():
+    """Reset the peak RSS counter so allocations made while building the input are not counted."""
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def inline_pipeline(upload, spool_dir):
+    """The previous path: copy the upload, wrap it in an inline Part and serialize the request."""
+    file_bytes = upload.getvalue()
+    part = types.Part.from_bytes(data=file_bytes, mime_type="video/mp4")
+    body = types.Content(role="user", parts=[part]).model_dump_json()
+    return len(body)
+
+
+def spooled_pipeline(upload, spool_dir):
+    """The current path: spool and hash through a memoryview, then stream the file in blocks."""
+    path, digest = uploads.spool_upload(upload, spool_dir)
+    sent = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b""):
+            sent += len(chunk)
+    return sent
+
+
+PIPELINES = {"inline": inline_pipeline, "spooled": spooled_pipeline}
+
+
+def run_child(name, size_mb):
+    upload = io.BytesIO(os.urandom(size_mb * 1024 * 1024))
+    reset_peak()
+    baseline = read_status_kb("VmRSS")
+    with tempfile.TemporaryDirectory() as spool_dir:
+        PIPELINES[name](upload, spool_dir)
+    peak = read_status_kb("VmHWM")
+    print(max(peak - baseline, 0))
+
+
+def main():
+    if len(sys.argv) == 3:
+        run_child(sys.argv[1], int(sys.argv[2]))
+        return
+
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(f"Peak RSS above the {size_mb} MB upload itself:")
+    for name in PIPELINES:
+        output = subprocess.run(
+            [sys.executable, __file__, name, str(size_mb)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        extra_mb = int(output.strip()) / 1024
+        print(f"  {name:<8} {extra_mb:8.1f} MB  ({extra_mb / size_mb:.2f} extra copies)")
+
+
+if __name__ == "__main__":
+    main()
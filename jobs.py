@@ -0,0 +1,183 @@
+import concurrent.futures
+import logging
+import threading
+import time
+import types
+import uuid
+
+logger = logging.getLogger("student_assistant")
+
+
+class Job:
+    """
+    A workflow running in the background, independent of the session (and script run) that submitted it.
+
+    The job works on its own copy of the workflow state, sessions attach to it by its id and copy
+    the results back as they arrive.
+
+    :ivar id: The job id, used to attach to the job again (e.g. after a page refresh).
+    :ivar key: Key of the work the job does, a job with the same key is reused instead of started again.
+    :ivar state: Namespace holding the workflow state the job reads and writes.
+    :ivar status: "running", "done" or "failed".
+    :ivar error: Message of the exception that ended a failed job.
+    """
+
+    def __init__(self, key, state):
+        """
+        :param key: Key of the work the job does, or None.
+        :param state: Dict of the initial workflow state.
+        """
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.state = types.SimpleNamespace(**state)
+        self.status = "running"
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+        self._lock = threading.Lock()
+        self._steps = {}
+        self._partial = {}
+        self._version = 0
+
+    @property
+    def version(self):
+        """A number that changes every time a step starts or ends, or the job finishes."""
+        with self._lock:
+            return self._version
+
+    def set_step(self, name, status):
+        """
+        Record the progress of a workflow step.
+
+        :param name: The step name (e.g. "flashcards").
+        :param status: "running", "done" or "failed".
+        """
+        with self._lock:
+            self._steps[name] = status
+            self._version += 1
+
+    def steps(self):
+        """
+        :return: Dict of step name to status, in the order the steps started.
+        """
+        with self._lock:
+            return dict(self._steps)
+
+    def set_partial(self, name, text):
+        """
+        Keep the latest rendering of a result that is still being streamed.
+
+        :param name: The step name.
+        :param text: The Markdown received so far.
+        """
+        with self._lock:
+            self._partial[name] = text
+
+    def partial(self, name):
+        """
+        :param name: The step name.
+        :return: The Markdown streamed so far, or None.
+        """
+        with self._lock:
+            return self._partial.get(name)
+
+    def finish(self, error=None):
+        """
+        Mark the job as finished.
+
+        :param error: The exception that ended the job, if it failed.
+        """
+        with self._lock:
+            self.status = "failed" if error is not None else "done"
+            self.error = str(error) if error is not None else None
+            self.finished = time.time()
+            self._version += 1
+
+
+class JobSlot:
+    """
+    Stand-in for an st.empty placeholder inside a job: what is streamed into it is kept on the job
+    (see Job.partial) for the sessions polling it.
+    """
+
+    def __init__(self, job, name):
+        """
+        :param job: The Job.
+        :param name: The step the streamed result belongs to.
+        """
+        self.job = job
+        self.name = name
+
+    def markdown(self, text):
+        """
+        :param text: The Markdown received so far.
+        """
+        self.job.set_partial(self.name, text)
+
+
+class JobRunner:
+    """
+    A pool of worker threads running workflows as background jobs, shared by every session.
+
+    Jobs live outside the Streamlit script run, so a refresh, a tab switch or a websocket reconnect
+    doesn't stop them. Finished jobs are kept for ttl_seconds so a session can still attach to them.
+    """
+
+    def __init__(self, metrics, max_workers=8, ttl_seconds=60 * 60):
+        """
+        :param metrics: The Metrics receiving the job counts and durations.
+        :param max_workers: Number of jobs that run at the same time, later ones wait in line.
+        :param ttl_seconds: How long finished jobs are kept.
+        """
+        self.metrics = metrics
+        self.ttl_seconds = ttl_seconds
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="workflow-job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+
+    def submit(self, function, state, key=None):
+        """
+        Start a job, or attach to the running job doing the same work.
+
+        :param function: Callable run in a worker thread with the Job as its only argument.
+        :param state: Dict of the initial workflow state of the job.
+        :param key: Optional key of the work, see Job.key.
+        :return: The Job.
+        """
+        with self._lock:
+            self._prune()
+            if key is not None:
+                for job in self._jobs.values():
+                    if job.key == key and job.status == "running":
+                        return job
+            job = Job(key, state)
+            self._jobs[job.id] = job
+        self.metrics.increment("jobs_submitted_total")
+        self._pool.submit(self._run, job, function)
+        return job
+
+    def get(self, job_id):
+        """
+        :param job_id: The job id.
+        :return: The Job, or None if it is unknown or expired.
+        """
+        with self._lock:
+            self._prune()
+            return self._jobs.get(job_id)
+
+    def _run(self, job, function):
+        start = time.monotonic()
+        try:
+            function(job)
+        except Exception as e:
+            logger.exception("Job %s failed", job.id)
+            job.finish(e)
+        else:
+            job.finish()
+        self.metrics.increment("jobs_finished_total", status=job.status)
+        self.metrics.observe("job_seconds", time.monotonic() - start)
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl_seconds
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished and job.finished < cutoff]:
+            del self._jobs[job_id]
@@ -0,0 +1,130 @@
+import collections
+import threading
+import time
+
+
+class Metrics:
+    """
+    Process-wide counters and timing samples for the calls the app makes, shared by every session.
+
+    Every metric is identified by a name plus optional labels (e.g. the model). Timings keep
+    their count, sum and maximum, plus a window of recent timestamped samples for percentiles.
+    Gauges hold the latest value of something that goes up and down (e.g. a queue length).
+    """
+
+    def __init__(self, window=1000):
+        """
+        :param window: Number of recent samples kept per timing for percentiles.
+        """
+        self.window = window
+        self._lock = threading.Lock()
+        self._counters = collections.defaultdict(int)
+        self._timings = {}
+        self._gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        if not labels:
+            return name
+        return name + "{" + ",".join(f"{label}={value}" for label, value in sorted(labels.items())) + "}"
+
+    def increment(self, name, value=1, **labels):
+        """
+        Add to a counter.
+
+        :param name: The counter name.
+        :param value: The amount to add.
+        :param labels: Labels identifying the series.
+        """
+        with self._lock:
+            self._counters[self._key(name, labels)] += value
+
+    def set_gauge(self, name, value, **labels):
+        """
+        Set a gauge to its current value.
+
+        :param name: The gauge name.
+        :param value: The current value.
+        :param labels: Labels identifying the series.
+        """
+        with self._lock:
+            self._gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """
+        Record a timing (or any other measured value).
+
+        :param name: The timing name.
+        :param value: The measured value, in seconds for durations.
+        :param labels: Labels identifying the series.
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            timing = self._timings.get(key)
+            if timing is None:
+                timing = self._timings[key] = {
+                    "count": 0, "sum": 0.0, "max": 0.0, "samples": collections.deque(maxlen=self.window)
+                }
+            timing["count"] += 1
+            timing["sum"] += value
+            timing["max"] = max(timing["max"], value)
+            timing["samples"].append((time.time(), value))
+
+    def counter(self, name, **labels):
+        """
+        Read a counter.
+
+        :param name: The counter name.
+        :param labels: Labels identifying the series.
+        :return: The current value (0 if it was never incremented).
+        """
+        with self._lock:
+            return self._counters.get(self._key(name, labels), 0)
+
+    def percentile(self, name, q, max_age=None, min_samples=1, **labels):
+        """
+        Compute a percentile over the recent samples of a timing.
+
+        :param name: The timing name.
+        :param q: The percentile, between 0 and 100.
+        :param max_age: Only use samples recorded in the last max_age seconds.
+        :param min_samples: Minimum number of samples needed for a meaningful result.
+        :param labels: Labels identifying the series.
+        :return: The percentile, or None if fewer than min_samples samples were recorded.
+        """
+        cutoff = time.time() - max_age if max_age is not None else 0
+        with self._lock:
+            timing = self._timings.get(self._key(name, labels))
+            samples = sorted(value for recorded, value in timing["samples"] if recorded >= cutoff) if timing else []
+        if not samples or len(samples) < min_samples:
+            return None
+        return samples[min(int(len(samples) * q / 100), len(samples) - 1)]
+
+    def snapshot(self):
+        """
+        Export every metric.
+
+        :return: A dict with the "counters", the "gauges" and a summary (count, mean, p50, p95, max)
+                 of the "timings".
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            timings = {
+                key: (timing["count"], timing["sum"], timing["max"], sorted(value for _, value in timing["samples"]))
+                for key, timing in self._timings.items()
+            }
+
+        def summarize(count, total, maximum, samples):
+            def pick(q):
+                return round(samples[min(int(len(samples) * q / 100), len(samples) - 1)], 3)
+            return {
+                "count": count, "mean": round(total / count, 3), "p50": pick(50), "p95": pick(95),
+                "max": round(maximum, 3)
+            }
+
+        return {
+            "counters": dict(sorted(counters.items())),
+            "gauges": dict(sorted(gauges.items())),
+            "timings": {key: summarize(*timing) for key, timing in sorted(timings.items())},
+        }
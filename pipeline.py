@@ -0,0 +1,187 @@
+import concurrent.futures
+import hashlib
+import json
+
+
+class PipelineError(Exception):
+    """A node was not run because a node it depends on failed."""
+
+
+class Node:
+    """
+    A step of a pipeline: a function of the outputs of other nodes (its inputs) and of its params.
+    """
+
+    def __init__(self, name, function, inputs=(), params=None, cacheable=True):
+        """
+        :param name: Name of the node, which is also the name of its output.
+        :param function: Callable computing the output, called with the input values and the params
+                         as keyword arguments.
+        :param inputs: Names of the nodes whose outputs the node reads.
+        :param params: Optional callable returning a dict of JSON serializable parameters (e.g. the
+                       prompt version and the model), evaluated once per run. They are passed to
+                       function and are part of the cache key.
+        :param cacheable: Whether the output may be cached, it must then be JSON serializable.
+        """
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.params = params
+        self.cacheable = cacheable
+
+
+class Pipeline:
+    """
+    A DAG of nodes, where every node runs as soon as its inputs are ready and independent nodes run
+    concurrently.
+
+    Every node has a digest computed from its name, its params and the digests of its inputs, so it
+    is known before anything runs. Outputs are cached by that digest: a node whose inputs and params
+    didn't change is not run again, and editing a prompt only recomputes the nodes that use it and
+    the nodes downstream of them.
+
+    A node that returned None (e.g. an optional step that failed) doesn't have the output its digest
+    stands for, so the nodes reading it are run without the cache.
+    """
+
+    def __init__(self, nodes):
+        """
+        :param nodes: The Nodes.
+        :raises ValueError: If a node reads an unknown node, or the nodes form a cycle.
+        """
+        self.nodes = {node.name: node for node in nodes}
+        for node in nodes:
+            for name in node.inputs:
+                if name not in self.nodes:
+                    raise ValueError(f"Node {node.name} reads unknown node {name}.")
+        self.order = self._sort()
+
+    def _sort(self):
+        order = []
+        visiting = set()
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f"The pipeline has a cycle through {name}.")
+            visiting.add(name)
+            for input_name in self.nodes[name].inputs:
+                visit(input_name)
+            visiting.discard(name)
+            order.append(name)
+
+        for name in self.nodes:
+            visit(name)
+        return order
+
+    def run(self, targets=None, values=None, force=(), cache=None, wrap=None, on_update=None, max_workers=4):
+        """
+        Compute the target nodes, and the nodes they depend on that are not known yet.
+
+        :param targets: Names of the nodes to compute, every node by default.
+        :param values: Dict of outputs that are already known by node name, those nodes are not run.
+        :param force: Names of nodes to run even if their output is known or cached. Their new output
+                      replaces the cached one.
+        :param cache: Optional result_cache.ResultCache for the outputs of cacheable nodes. Empty
+                      outputs (e.g. None) are not cached, and neither are the outputs of nodes with
+                      a None input.
+        :param wrap: Optional function wrapping every node function before it is handed to a worker
+                     thread (e.g. to give it the context of the calling thread).
+        :param on_update: Optional callback(name, status, result), called from the calling thread when a
+                          node starts ("running", result None) and ends ("done" or "cached" with its
+                          output, "failed" with the exception). Dependents start after it returns.
+        :param max_workers: Number of nodes that run at the same time.
+        :return: A (outputs, errors) tuple of dicts by node name. Nodes that depend on a failed node
+                 fail with a PipelineError.
+        """
+        outputs = dict(values or {})
+        force = set(force)
+        params = {}
+        digests = {}
+
+        def digest(name):
+            if name not in digests:
+                node = self.nodes[name]
+                params[name] = node.params() if node.params else {}
+                payload = json.dumps([name, params[name], [digest(i) for i in node.inputs]], sort_keys=True)
+                digests[name] = hashlib.sha256(payload.encode("utf-8")).hexdigest()
+            return digests[name]
+
+        # Walk up from the targets, known outputs don't need their inputs
+        pending = set()
+        stack = list(self.nodes if targets is None else targets)
+        while stack:
+            name = stack.pop()
+            if name in pending or (name in outputs and name not in force):
+                continue
+            pending.add(name)
+            stack.extend(self.nodes[name].inputs)
+        pending = [name for name in self.order if name in pending]
+        for name in pending:
+            digest(name)
+            # A forced node's known output is stale, its dependents must wait for the new one
+            outputs.pop(name, None)
+
+        def notify(name, status, result=None):
+            if on_update is not None:
+                on_update(name, status, result)
+
+        errors = {}
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="pipeline") as pool:
+            while pending or running:
+                for name in list(pending):
+                    node = self.nodes[name]
+                    failed = next((i for i in node.inputs if i in errors), None)
+                    if failed is not None:
+                        pending.remove(name)
+                        errors[name] = PipelineError(f"{name} was skipped because {failed} failed: {errors[failed]}")
+                        notify(name, "failed", errors[name])
+                    elif all(i in outputs for i in node.inputs):
+                        pending.remove(name)
+                        function = node.function if wrap is None else wrap(node.function)
+                        kwargs = {i: outputs[i] for i in node.inputs}
+                        kwargs.update(params[name])
+                        notify(name, "running")
+                        fallback = any(outputs[i] is None for i in node.inputs)
+                        future = pool.submit(
+                            self._compute, node, function, kwargs, digests[name], None if fallback else cache,
+                            name in force
+                        )
+                        running[future] = name
+                if not running:
+                    continue
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        output, cached = future.result()
+                    except Exception as e:
+                        errors[name] = e
+                        notify(name, "failed", e)
+                    else:
+                        outputs[name] = output
+                        notify(name, "cached" if cached else "done", output)
+        return outputs, errors
+
+    @staticmethod
+    def _compute(node, function, kwargs, digest, cache, force):
+        if cache is None or not node.cacheable:
+            return function(**kwargs), False
+        key = ("pipeline", node.name, digest)
+        if force:
+            output = function(**kwargs)
+            if output:
+                cache.set(key, output)
+            return output, False
+
+        computed = False
+
+        def compute():
+            nonlocal computed
+            computed = True
+            return function(**kwargs)
+
+        output = cache.get_or_compute(key, compute, cacheable=bool)
+        return output, not computed
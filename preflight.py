@@ -0,0 +1,137 @@
+import math
+
+import routing
+
+# Expected length of each generated artifact, in tokens
+OUTPUT_TOKENS = {
+    "concept_map": 1200,
+    "flashcards": 1500,
+    "first_question": 150,
+    "grading": 300,
+}
+
+# Tokens of a transcript per second of recording (about 150 spoken words per minute)
+TRANSCRIPT_TOKENS_PER_SECOND = 4
+
+# Tokens per image or sampled video frame at the default and at the low media resolution
+IMAGE_TOKENS = 258
+LOW_RESOLUTION_IMAGE_TOKENS = 64
+
+# Rough throughput of the models, used to project how long the workflow takes
+REQUEST_OVERHEAD_SECONDS = 2.0
+INPUT_TOKENS_PER_SECOND = 20000
+OUTPUT_TOKENS_PER_SECOND = 150
+
+
+def media_frames(source_file, duration=None):
+    """
+    Count the images (and sampled video frames) in a preprocessed upload, whose tokens depend on
+    the media resolution.
+
+    :param source_file: Dict describing the preprocessed file, see preprocess.prepare_upload.
+    :param duration: Length of the recording in seconds, if known.
+    :return: The number of images the model sees.
+    """
+    frames = sum(1 for attachment in source_file.get("attachments") or [] if attachment["mime_type"].startswith("image/"))
+    if source_file["mime_type"].startswith("image/"):
+        frames += 1
+    elif source_file["mime_type"].startswith("video/") and duration:
+        # Videos sent as is are sampled at one frame per second
+        frames += math.ceil(duration)
+    return frames
+
+
+def plan_steps(payload_tokens, prompt_tokens, transcript_tokens=None, segments=0, segment_share=1.0):
+    """
+    List the model calls the workflow will make with their token counts.
+
+    :param payload_tokens: Tokens of the uploaded material, as it is sent.
+    :param prompt_tokens: Mapping of task to the tokens of its prompt (and of the merge prompt, under
+                          "<task>_merge", for segmented material).
+    :param transcript_tokens: Expected tokens of the transcript if the recording is transcribed first,
+                              later steps then send the transcript instead of the material.
+    :param segments: Number of segments the concept map and flashcards are generated from (0 if not segmented).
+    :param segment_share: Fraction of the material covered by those segments (less than 1 when sampling).
+    :return: A list of step dicts with the "task", total "input_tokens" and "output_tokens", the number
+             of "calls" (made in parallel) and the "request_tokens" of the largest call.
+    """
+    def step(task, input_tokens, output_tokens, calls=1):
+        return {
+            "task": task,
+            "input_tokens": int(input_tokens),
+            "output_tokens": int(output_tokens),
+            "calls": calls,
+            "request_tokens": int(input_tokens / calls),
+        }
+
+    steps = []
+    context_tokens = payload_tokens
+    if transcript_tokens is not None:
+        steps.append(step("transcript", payload_tokens + prompt_tokens["transcript"], transcript_tokens))
+        context_tokens = transcript_tokens
+        segments = 0
+
+    for task in ("concept_map", "flashcards"):
+        if segments:
+            # One call per segment, then a text-only call merging their results
+            map_input = payload_tokens * segment_share + segments * prompt_tokens[task]
+            steps.append(step(task, map_input, segments * OUTPUT_TOKENS[task], calls=segments))
+            merge_input = segments * OUTPUT_TOKENS[task] + prompt_tokens[f"{task}_merge"]
+            steps.append(step(task, merge_input, OUTPUT_TOKENS[task]))
+        else:
+            steps.append(step(task, context_tokens + prompt_tokens[task], OUTPUT_TOKENS[task]))
+
+    steps.append(step("first_question", context_tokens + prompt_tokens["first_question"], OUTPUT_TOKENS["first_question"]))
+    return steps
+
+
+def step_seconds(step):
+    """
+    Project how long a step takes (its calls run in parallel).
+
+    :param step: A step dict from plan_steps.
+    :return: The projected latency in seconds.
+    """
+    return (
+        REQUEST_OVERHEAD_SECONDS
+        + step["request_tokens"] / INPUT_TOKENS_PER_SECOND
+        + step["output_tokens"] / step["calls"] / OUTPUT_TOKENS_PER_SECOND
+    )
+
+
+def project(steps, models):
+    """
+    Project the tokens, cost and duration of a workflow. The transcript comes first, then the other
+    tasks run concurrently, so the duration is the transcript plus the slowest of them.
+
+    :param steps: The step dicts from plan_steps.
+    :param models: Mapping of task to the model it runs on.
+    :return: A dict with the total "input_tokens" and "output_tokens", the "cost" in USD (None if a
+             model has no known price), the projected "seconds" and the largest "request_tokens".
+    """
+    cost = 0.0
+    task_seconds = {}
+    for step in steps:
+        task_seconds[step["task"]] = task_seconds.get(step["task"], 0.0) + step_seconds(step)
+        step_cost = routing.cost(models[step["task"]], step["input_tokens"], step["output_tokens"])
+        cost = None if cost is None or step_cost is None else cost + step_cost
+    return {
+        "input_tokens": sum(step["input_tokens"] for step in steps),
+        "output_tokens": sum(step["output_tokens"] for step in steps),
+        "cost": cost,
+        "seconds": task_seconds.pop("transcript", 0.0) + max(task_seconds.values(), default=0.0),
+        "request_tokens": max(step["request_tokens"] for step in steps),
+    }
+
+
+def sample_segments(count, keep):
+    """
+    Pick evenly spaced segments to analyse when there is no budget for all of them.
+
+    :param count: Total number of segments.
+    :param keep: Number of segments to keep.
+    :return: The sorted indexes of the kept segments.
+    """
+    if keep >= count:
+        return list(range(count))
+    return sorted({round(i * (count - 1) / max(keep - 1, 1)) for i in range(keep)})
@@ -0,0 +1,840 @@
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+import pypdf
+from PIL import Image
+from PIL import ImageOps
+
+# ffmpeg is an optional system dependency (see packages.txt), stages that need it are skipped without it
+FFMPEG = shutil.which("ffmpeg")
+
+# Speech only needs mono audio at 16 kHz, Opus keeps it intelligible at very low bitrates
+AUDIO_SAMPLE_RATE = 16000
+AUDIO_BITRATE = "24k"
+
+# Stretches quieter than this for at least this long count as dead air
+SILENCE_THRESHOLD_DB = -35
+SILENCE_MIN_DURATION = 2.0
+# Audio kept on each side of a removed silence so speech is not clipped
+SILENCE_PADDING = 0.25
+# Trimming is skipped when it would remove less than this fraction of the recording
+SILENCE_MIN_SAVING = 0.05
+
+# Video is split into its audio track plus frames sampled on scene changes (slide changes)
+# and at least every VIDEO_FRAME_INTERVAL seconds, scaled down to a single image tile
+VIDEO_SCENE_THRESHOLD = 0.3
+VIDEO_FRAME_INTERVAL = 120
+VIDEO_MIN_FRAME_GAP = 5
+VIDEO_MAX_FRAMES = 100
+VIDEO_FRAME_WIDTH = 768
+
+# PDF pages with at least this much extractable text are sent as text
+PDF_MIN_PAGE_CHARS = 40
+# Pages containing an image of at least this many pixels are image-heavy (logos and icons are smaller)
+PDF_MIN_IMAGE_PIXELS = 250_000
+# The text layer is only used when enough of the document has one
+PDF_MIN_TEXT_COVERAGE = 0.5
+# Gemini processes every PDF page as an image, text costs roughly one token per four characters
+PDF_PAGE_TOKENS = 258
+CHARS_PER_TOKEN = 4
+
+# Gemini tiles images larger than 384 px into 768 px crops, two tiles per side keep handwriting legible
+IMAGE_MAX_SIDE = 1536
+IMAGE_QUALITY = 80
+
+# Long material is split into segments of about this size for map-reduce processing,
+# material up to 1.5 times this size is processed in one piece
+SEGMENT_SECONDS = 40 * 60
+SEGMENT_PAGES = 60
+
+# Only the bracketed form the prompts ask for is remapped, so times of day, scores or verse
+# references (e.g. "John 3:16") in the text are left alone
+TIMESTAMP_PATTERN = re.compile(r"\[(?:(\d{1,2}):)?(\d{1,2}):(\d{2})\]")
+
+
+def format_size(num_bytes):
+    """
+    Format a byte count for display.
+
+    :param num_bytes: The number of bytes.
+    :return: A human readable size such as "12.3 MB".
+    """
+    for unit in ("B", "KB", "MB"):
+        if num_bytes < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} GB"
+
+
+def variant_key(key, stage):
+    """
+    Derive the content key of a preprocessed file from its input key and the stage settings.
+
+    :param key: The content key of the input file.
+    :param stage: A string describing the stage and its settings.
+    :return: The hex key of the output file.
+    """
+    return hashlib.sha256(f"{key}:{stage}".encode("utf-8")).hexdigest()
+
+
+def reuse_output(path):
+    """
+    Check whether a preprocessed file or directory already exists, and mark it as recently used.
+
+    Outputs are shared between sessions, refreshing their modification time keeps
+    uploads.sweep_spool from removing them while a session still uses them.
+
+    :param path: Path of the output.
+    :return: True if the output exists.
+    """
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def run_ffmpeg(args, output_path):
+    """
+    Run ffmpeg and atomically move its output into place.
+
+    :param args: ffmpeg arguments (inputs and options) without the output file.
+    :param output_path: Where the output file should end up.
+    """
+    suffix = os.path.splitext(output_path)[1]
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_path), suffix=suffix)
+    os.close(fd)
+    try:
+        subprocess.run(
+            [FFMPEG, "-hide_banner", "-loglevel", "error", "-y", *args, tmp_path],
+            check=True, capture_output=True
+        )
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def format_timestamp(seconds):
+    """
+    Format a position in a recording as [H:]MM:SS.
+
+    :param seconds: The position in seconds.
+    :return: The formatted timestamp.
+    """
+    minutes, secs = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+    return f"{minutes:02d}:{secs:02d}"
+
+
+def parse_duration(log):
+    """
+    Read the length of the input from ffmpeg's log output.
+
+    :param log: The stderr output of an ffmpeg run.
+    :return: The duration in seconds.
+    """
+    match = re.search(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)", log)
+    if not match:
+        raise ValueError("Could not determine the length of the recording.")
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def probe_duration(path):
+    """
+    Get the length of an audio or video file.
+
+    :param path: Path of the file.
+    :return: The duration in seconds.
+    """
+    # Without an output ffmpeg only prints the input information (and exits with an error)
+    result = subprocess.run([FFMPEG, "-hide_banner", "-i", path], capture_output=True, text=True)
+    return parse_duration(result.stderr)
+
+
+def detect_silences(path):
+    """
+    Find the silent spans of a recording with ffmpeg's silencedetect filter.
+
+    :param path: Path of the audio or video file.
+    :return: A (duration, silences) tuple, silences being a list of (start, end) seconds.
+    """
+    result = subprocess.run(
+        [FFMPEG, "-hide_banner", "-nostats", "-i", path, "-vn",
+         "-af", f"silencedetect=noise={SILENCE_THRESHOLD_DB}dB:d={SILENCE_MIN_DURATION}",
+         "-f", "null", "-"],
+        check=True, capture_output=True, text=True
+    )
+    log = result.stderr
+    duration = parse_duration(log)
+
+    starts = [float(t) for t in re.findall(r"silence_start: (-?\d+(?:\.\d+)?)", log)]
+    ends = [float(t) for t in re.findall(r"silence_end: (-?\d+(?:\.\d+)?)", log)]
+    # A recording that ends in silence has no final silence_end
+    ends += [duration] * (len(starts) - len(ends))
+    return duration, [(max(start, 0.0), end) for start, end in zip(starts, ends)]
+
+
+def build_timeline(duration, silences):
+    """
+    Work out which parts of a recording are kept once silences are compressed.
+
+    :param duration: Length of the recording in seconds.
+    :param silences: List of (start, end) silent spans in seconds.
+    :return: A timeline of [original_start, original_end, trimmed_start] entries for the kept spans.
+    """
+    timeline = []
+    position = 0.0
+    trimmed = 0.0
+    for start, end in silences:
+        cut_start = 0.0 if start <= 0 else start + SILENCE_PADDING
+        cut_end = duration if end >= duration else end - SILENCE_PADDING
+        if cut_end <= cut_start:
+            continue
+        if cut_start > position:
+            timeline.append([position, cut_start, trimmed])
+            trimmed += cut_start - position
+        position = cut_end
+    if position < duration:
+        timeline.append([position, duration, trimmed])
+    return timeline
+
+
+def original_time(seconds, timeline):
+    """
+    Map a position in the trimmed recording back to the original recording.
+
+    :param seconds: Position in the trimmed recording.
+    :param timeline: The timeline returned by build_timeline.
+    :return: The corresponding position in the original recording.
+    """
+    for original_start, original_end, trimmed_start in timeline:
+        if seconds < trimmed_start + (original_end - original_start):
+            return original_start + max(seconds - trimmed_start, 0.0)
+    if not timeline:
+        return seconds
+    original_start, original_end, trimmed_start = timeline[-1]
+    return original_start + (seconds - trimmed_start)
+
+
+def trimmed_time(seconds, timeline):
+    """
+    Map a position in the original recording to the trimmed recording.
+
+    Positions inside a removed silence map to the point where the recording resumes.
+
+    :param seconds: Position in the original recording.
+    :param timeline: The timeline returned by build_timeline, or None if nothing was trimmed.
+    :return: The corresponding position in the trimmed recording.
+    """
+    if not timeline:
+        return seconds
+    for original_start, original_end, trimmed_start in timeline:
+        if seconds <= original_end:
+            return trimmed_start + max(seconds - original_start, 0.0)
+    original_start, original_end, trimmed_start = timeline[-1]
+    return trimmed_start + (original_end - original_start)
+
+
+def remap_timestamps(text, timeline):
+    """
+    Rewrite [MM:SS] and [H:MM:SS] timestamps in model output so they refer to the original recording.
+
+    :param text: Text generated from the trimmed recording.
+    :param timeline: The timeline returned by build_timeline.
+    :return: The text with its timestamps mapped back.
+    """
+    def replace(match):
+        hours, minutes, seconds = match.groups()
+        if int(seconds) >= 60:
+            return match.group(0)
+        position = int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds)
+        return f"[{format_timestamp(original_time(position, timeline))}]"
+
+    return TIMESTAMP_PATTERN.sub(replace, text)
+
+
+def trim_silence(source_file, spool_dir):
+    """
+    Remove dead air (breaks, projector setup, the minutes after class) from a recording.
+
+    Audio is written losslessly as FLAC (the transcoding stage compresses it afterwards) and
+    video is re-encoded with both streams cut at the same points.
+
+    :param source_file: Dict with the "path", "mime_type", "name" and "key" of the input.
+    :param spool_dir: Directory that holds the spooled files.
+    :return: A (source_file, removed_seconds, duration) tuple, source_file gaining a "timeline"
+             that maps trimmed positions back to the original. The input is returned unchanged
+             if there is too little silence to be worth trimming.
+    """
+    duration, silences = detect_silences(source_file["path"])
+    timeline = build_timeline(duration, silences)
+    kept = sum(end - start for start, end, _ in timeline)
+    removed = duration - kept
+    if not timeline or removed < duration * SILENCE_MIN_SAVING:
+        return source_file, 0.0, duration
+
+    is_video = source_file["mime_type"].startswith("video/")
+    stage = f"silence:{SILENCE_THRESHOLD_DB}:{SILENCE_MIN_DURATION}:{SILENCE_PADDING}"
+    key = variant_key(source_file["key"], stage)
+    output_path = os.path.join(spool_dir, f"{key}.{'mp4' if is_video else 'flac'}")
+
+    if not reuse_output(output_path):
+        condition = "+".join(f"between(t,{start:.3f},{end:.3f})" for start, end, _ in timeline)
+        args = ["-i", source_file["path"], "-af", f"aselect='{condition}',asetpts=N/SR/TB"]
+        if is_video:
+            args += ["-vf", f"select='{condition}',setpts=N/FRAME_RATE/TB",
+                     "-c:v", "libx264", "-preset", "veryfast", "-c:a", "aac"]
+        else:
+            args += ["-vn", "-c:a", "flac"]
+        run_ffmpeg(args, output_path)
+
+    trimmed_file = {
+        **source_file,
+        "path": output_path,
+        "mime_type": "video/mp4" if is_video else "audio/flac",
+        "key": key,
+        "timeline": timeline
+    }
+    return trimmed_file, removed, duration
+
+
+def transcode_audio(source_file, spool_dir):
+    """
+    Downmix, resample and re-encode an audio upload to speech quality Opus.
+
+    :param source_file: Dict with the "path", "mime_type", "name" and "key" of the input.
+    :param spool_dir: Directory that holds the spooled files.
+    :return: A source_file dict describing the transcoded file.
+    """
+    stage = f"audio:opus:{AUDIO_SAMPLE_RATE}:{AUDIO_BITRATE}"
+    key = variant_key(source_file["key"], stage)
+    output_path = os.path.join(spool_dir, f"{key}.ogg")
+
+    # Identical content was already transcoded (by this or another session)
+    if not reuse_output(output_path):
+        run_ffmpeg([
+            "-i", source_file["path"],
+            "-vn", "-ac", "1", "-ar", str(AUDIO_SAMPLE_RATE),
+            "-c:a", "libopus", "-b:a", AUDIO_BITRATE, "-application", "voip"
+        ], output_path)
+
+    return {**source_file, "path": output_path, "mime_type": "audio/ogg", "key": key}
+
+
+def extract_audio_track(source_file, spool_dir):
+    """
+    Extract the audio track of a video losslessly so it can go through the audio stages.
+
+    :param source_file: Dict with the "path", "mime_type", "name" and "key" of the video.
+    :param spool_dir: Directory that holds the spooled files.
+    :return: A source_file dict describing the audio track, with the video kept as "video_path".
+    """
+    key = variant_key(source_file["key"], "video:audio")
+    output_path = os.path.join(spool_dir, f"{key}.flac")
+    if not reuse_output(output_path):
+        run_ffmpeg(["-i", source_file["path"], "-vn", "-c:a", "flac"], output_path)
+    return {**source_file, "path": output_path, "mime_type": "audio/flac", "key": key,
+            "video_path": source_file["path"]}
+
+
+def sample_frames(video_path, video_key, spool_dir):
+    """
+    Sample frames from a video on scene changes and at a low fixed rate.
+
+    Only keyframes are decoded, which is enough to catch slide changes and much faster than
+    decoding every frame of a long lecture.
+
+    :param video_path: Path of the video.
+    :param video_key: The content key of the video.
+    :param spool_dir: Directory that holds the spooled files.
+    :return: A list of {"path", "time"} dicts, time being the position in the original video.
+    """
+    stage = (f"frames:{VIDEO_SCENE_THRESHOLD}:{VIDEO_FRAME_INTERVAL}:{VIDEO_MIN_FRAME_GAP}:"
+             f"{VIDEO_MAX_FRAMES}:{VIDEO_FRAME_WIDTH}")
+    frames_dir = os.path.join(spool_dir, f"{variant_key(video_key, stage)}.frames")
+    manifest_path = os.path.join(frames_dir, "frames.json")
+    if os.path.exists(manifest_path) and reuse_output(frames_dir):
+        with open(manifest_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    os.makedirs(frames_dir, exist_ok=True)
+    select = (
+        f"isnan(prev_selected_t)"
+        f"+gt(scene,{VIDEO_SCENE_THRESHOLD})*gte(t-prev_selected_t,{VIDEO_MIN_FRAME_GAP})"
+        f"+gte(t-prev_selected_t,{VIDEO_FRAME_INTERVAL})"
+    )
+    result = subprocess.run(
+        [FFMPEG, "-hide_banner", "-nostats", "-y", "-skip_frame", "nokey", "-i", video_path, "-an",
+         "-vf", f"select='{select}',showinfo,scale='min({VIDEO_FRAME_WIDTH},iw)':-2",
+         "-vsync", "vfr", "-q:v", "5", os.path.join(frames_dir, "frame_%04d.jpg")],
+        check=True, capture_output=True, text=True
+    )
+    times = [float(t) for t in re.findall(r"pts_time:\s*(-?\d+(?:\.\d+)?)", result.stderr)]
+    frames = [
+        {"path": os.path.join(frames_dir, f"frame_{index:04d}.jpg"), "time": max(time_, 0.0)}
+        for index, time_ in enumerate(times, start=1)
+    ]
+    frames = [frame for frame in frames if os.path.exists(frame["path"])]
+
+    # Thin out evenly if the lecture has more slide changes than we want to send
+    if len(frames) > VIDEO_MAX_FRAMES:
+        step = len(frames) / VIDEO_MAX_FRAMES
+        frames = [frames[int(i * step)] for i in range(VIDEO_MAX_FRAMES)]
+
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(frames, f)
+    return frames
+
+
+def shrink_image(source_file, spool_dir, enhance=False):
+    """
+    Downscale an image to the resolution the model actually uses and re-encode it as WebP.
+
+    :param source_file: Dict with the "path", "mime_type", "name" and "key" of the image.
+    :param spool_dir: Directory that holds the spooled files.
+    :param enhance: Whether to convert to grayscale and normalise contrast (for handwritten notes).
+    :return: A source_file dict describing the smaller image, or the input if re-encoding does not help.
+    """
+    stage = f"image:{IMAGE_MAX_SIDE}:{IMAGE_QUALITY}:{'enhance' if enhance else 'plain'}"
+    key = variant_key(source_file["key"], stage)
+    output_path = os.path.join(spool_dir, f"{key}.webp")
+
+    if not reuse_output(output_path):
+        with Image.open(source_file["path"]) as image:
+            # Phone photos are often stored sideways with an EXIF rotation
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((IMAGE_MAX_SIDE, IMAGE_MAX_SIDE), Image.Resampling.LANCZOS)
+            if enhance:
+                image = ImageOps.autocontrast(ImageOps.grayscale(image), cutoff=1)
+            elif image.mode not in ("RGB", "RGBA", "L"):
+                image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+            fd, tmp_path = tempfile.mkstemp(dir=spool_dir, suffix=".webp")
+            os.close(fd)
+            try:
+                image.save(tmp_path, "WEBP", quality=IMAGE_QUALITY, method=4)
+                os.replace(tmp_path, output_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    if os.path.getsize(output_path) >= os.path.getsize(source_file["path"]):
+        return source_file
+    return {**source_file, "path": output_path, "mime_type": "image/webp", "key": key}
+
+
+def has_large_image(page):
+    """
+    Check whether a PDF page contains a picture big enough to matter (a scan, diagram or photo).
+
+    :param page: A pypdf page.
+    :return: True if the page is image-heavy.
+    """
+    resources = page.get("/Resources")
+    xobjects = resources.get_object().get("/XObject") if resources else None
+    if not xobjects:
+        return False
+    for xobject in xobjects.get_object().values():
+        xobject = xobject.get_object()
+        if xobject.get("/Subtype") == "/Image":
+            if int(xobject.get("/Width", 0)) * int(xobject.get("/Height", 0)) >= PDF_MIN_IMAGE_PIXELS:
+                return True
+    return False
+
+
+def extract_pdf_text(source_file, spool_dir):
+    """
+    Replace a PDF by its text layer, with page markers, when most pages have one and it is
+    estimated to cost fewer tokens than the pages.
+
+    Scanned or image-heavy pages are kept as a smaller PDF attached to the text, so the model
+    still sees them as images.
+
+    :param source_file: Dict with the "path", "mime_type", "name" and "key" of the PDF.
+    :param spool_dir: Directory that holds the spooled files.
+    :return: A (source_file, report_line) tuple. The PDF is returned unchanged if it has too
+             little text, or too much text to save tokens.
+    """
+    key = variant_key(source_file["key"], f"pdf-text:{PDF_MIN_PAGE_CHARS}:{PDF_MIN_IMAGE_PIXELS}")
+    text_path = os.path.join(spool_dir, f"{key}.txt")
+    fallback_path = os.path.join(spool_dir, f"{key}.pages.pdf")
+    manifest_path = os.path.join(spool_dir, f"{key}.json")
+
+    if reuse_output(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+        for path in (text_path, fallback_path):
+            reuse_output(path)
+    else:
+        reader = pypdf.PdfReader(source_file["path"])
+        if reader.is_encrypted:
+            reader.decrypt("")
+
+        sections = []
+        fallback_pages = []
+        for number, page in enumerate(reader.pages, start=1):
+            text = (page.extract_text() or "").strip()
+            if len(text) < PDF_MIN_PAGE_CHARS or has_large_image(page):
+                fallback_pages.append(number)
+                text = f"{text}\n(This page is attached as an image.)".strip()
+            sections.append(f"--- Page {number} ---\n{text}")
+
+        manifest = {"pages": len(reader.pages), "fallback_pages": fallback_pages, "text_chars": 0}
+        if manifest["pages"] and 1 - len(fallback_pages) / manifest["pages"] >= PDF_MIN_TEXT_COVERAGE:
+            content = "\n\n".join(sections)
+            manifest["text_chars"] = len(content)
+            with open(text_path, "w", encoding="utf-8") as f:
+                f.write(content)
+            if fallback_pages:
+                writer = pypdf.PdfWriter()
+                for number in fallback_pages:
+                    writer.add_page(reader.pages[number - 1])
+                with open(fallback_path, "wb") as f:
+                    writer.write(f)
+        with open(manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+    pages, fallback_pages = manifest["pages"], manifest["fallback_pages"]
+    if not manifest["text_chars"]:
+        return source_file, f"PDF sent unchanged: only {pages - len(fallback_pages)} of {pages} pages have a text layer."
+
+    # Dense slides can hold more text than the flat per-page cost of sending them as a PDF
+    tokens_before = pages * PDF_PAGE_TOKENS
+    tokens_after = manifest["text_chars"] // CHARS_PER_TOKEN + len(fallback_pages) * PDF_PAGE_TOKENS
+    if tokens_after >= tokens_before:
+        return source_file, (
+            f"PDF sent unchanged: its text layer (~{tokens_after:,} tokens) is not smaller than "
+            f"the pages (~{tokens_before:,} tokens)."
+        )
+
+    text_file = {**source_file, "path": text_path, "mime_type": "text/plain", "key": key, "page_count": pages}
+    if fallback_pages:
+        label = f"[{'Pages' if len(fallback_pages) > 1 else 'Page'} {', '.join(map(str, fallback_pages))} as images]"
+        text_file["attachments"] = [
+            {"path": fallback_path, "mime_type": "application/pdf", "label": label, "pages": fallback_pages}
+        ]
+
+    return text_file, (
+        f"PDF sent as text for {pages - len(fallback_pages)} of {pages} pages: "
+        f"~{tokens_before:,} → ~{tokens_after:,} tokens per call "
+        f"({1 - tokens_after / tokens_before:.0%} fewer)"
+    )
+
+
+def prepare_upload(source_file, spool_dir, transcode=True, trim=True, decompose=True, pdf_text=True,
+                   shrink_images=True, enhance_images=False):
+    """
+    Run the preprocessing stages that apply to an upload before it is sent to Gemini.
+
+    Stages that fail or need missing tools are skipped, so the original file is always usable.
+
+    :param source_file: Dict with the "path", "mime_type", "name" and "key" of the spooled upload.
+    :param spool_dir: Directory that holds the spooled files.
+    :param transcode: Whether audio uploads are transcoded.
+    :param trim: Whether silent spans are removed from audio and video recordings.
+    :param decompose: Whether videos are split into their audio track and sampled frames.
+    :param pdf_text: Whether the text layer of PDFs is sent instead of the page images.
+    :param shrink_images: Whether images are downscaled and re-encoded.
+    :param enhance_images: Whether images are also converted to grayscale with normalised contrast.
+    :return: A (source_file, report) tuple with the file to send and a list of notes for the user.
+             Files sent as several parts (split videos, partially scanned PDFs) list the extra
+             parts under "attachments", each with its "path", "mime_type" and a text "label".
+    """
+    report = []
+    mime_type = source_file["mime_type"] or ""
+    is_recording = mime_type.startswith(("audio/", "video/"))
+    original_size = os.path.getsize(source_file["path"])
+
+    if pdf_text and mime_type == "application/pdf":
+        try:
+            source_file, report_line = extract_pdf_text(source_file, spool_dir)
+            report.append(report_line)
+        except (OSError, ValueError, pypdf.errors.PyPdfError) as e:
+            report.append(f"PDF sent unchanged: the text layer could not be read ({e}).")
+        return source_file, report
+
+    if shrink_images and mime_type.startswith("image/"):
+        try:
+            shrunk_file = shrink_image(source_file, spool_dir, enhance=enhance_images)
+            if shrunk_file is not source_file:
+                report.append(
+                    f"Image resized to at most {IMAGE_MAX_SIDE} px: "
+                    f"{format_size(original_size)} → {format_size(os.path.getsize(shrunk_file['path']))}"
+                )
+            source_file = shrunk_file
+        except OSError as e:
+            report.append(f"Image sent unchanged: it could not be re-encoded ({e}).")
+        return source_file, report
+
+    video_source = None
+    if decompose and mime_type.startswith("video/"):
+        if not FFMPEG:
+            report.append("Video sent whole: ffmpeg is not installed.")
+        else:
+            try:
+                video_source = source_file
+                source_file = extract_audio_track(source_file, spool_dir)
+                mime_type = source_file["mime_type"]
+            except (OSError, subprocess.CalledProcessError) as e:
+                video_source = None
+                report.append(f"Video sent whole: the audio track could not be extracted ({e}).")
+
+    if trim and is_recording:
+        if not FFMPEG:
+            report.append("Silence not trimmed: ffmpeg is not installed.")
+        else:
+            try:
+                source_file, removed, duration = trim_silence(source_file, spool_dir)
+                if removed:
+                    report.append(
+                        f"Removed {format_timestamp(removed)} of silence "
+                        f"({removed / duration:.0%} of {format_timestamp(duration)}), "
+                        f"timestamps are mapped back to the original recording."
+                    )
+            except (OSError, ValueError, subprocess.CalledProcessError) as e:
+                report.append(f"Silence not trimmed: detection failed ({e}).")
+
+    if transcode and mime_type.startswith("audio/"):
+        if not FFMPEG:
+            report.append("Audio sent unchanged: ffmpeg is not installed.")
+        else:
+            try:
+                source_file = transcode_audio(source_file, spool_dir)
+                after = os.path.getsize(source_file["path"])
+                if not video_source:
+                    report.append(
+                        f"Audio transcoded to mono {AUDIO_SAMPLE_RATE // 1000} kHz Opus: "
+                        f"{format_size(original_size)} → {format_size(after)}"
+                    )
+            except (OSError, subprocess.CalledProcessError) as e:
+                report.append(f"Audio sent unchanged: transcoding failed ({e}).")
+
+    if video_source:
+        try:
+            frames = sample_frames(video_source["path"], video_source["key"], spool_dir)
+        except (OSError, subprocess.CalledProcessError) as e:
+            report.append(f"Video sent whole: frames could not be sampled ({e}).")
+            return video_source, report
+
+        # Frames are labelled on the same (trimmed) timeline as the audio the model hears
+        timeline = source_file.get("timeline")
+        frames = [
+            {"path": frame["path"], "time": trimmed_time(frame["time"], timeline)}
+            for frame in frames
+        ]
+        attachments = [
+            {
+                "path": frame["path"],
+                "mime_type": "image/jpeg",
+                "label": f"[Frame at {format_timestamp(frame['time'])}]",
+                "time": frame["time"]
+            }
+            for frame in frames
+        ]
+        source_file = {**source_file, "attachments": attachments}
+        payload = os.path.getsize(source_file["path"]) + sum(os.path.getsize(f["path"]) for f in frames)
+        report.append(
+            f"Video split into its audio track and {len(frames)} sampled frames: "
+            f"{format_size(original_size)} → {format_size(payload)}"
+        )
+
+    return source_file, report
+
+
+def segment_count(size, segment_size):
+    """
+    Decide how many segments material of a given size is split into.
+
+    :param size: Length of the material (seconds or pages).
+    :param segment_size: Target size of a segment.
+    :return: The number of segments, 1 if the material is short enough to process whole.
+    """
+    if size <= segment_size * 1.5:
+        return 1
+    return math.ceil(size / segment_size)
+
+
+def segment_timeline(timeline, start, end):
+    """
+    Build the timeline of one segment of a (possibly trimmed) recording.
+
+    :param timeline: The timeline of the whole recording, or None if it was not trimmed.
+    :param start: Start of the segment in the (trimmed) recording, in seconds.
+    :param end: End of the segment in the (trimmed) recording, in seconds.
+    :return: A timeline mapping positions in the segment to the original recording, or None if
+             positions in the segment already are positions in the original recording.
+    """
+    if not timeline:
+        return [[start, end, 0.0]] if start else None
+    result = []
+    for original_start, original_end, trimmed_start in timeline:
+        trimmed_end = trimmed_start + (original_end - original_start)
+        low, high = max(trimmed_start, start), min(trimmed_end, end)
+        if low < high:
+            result.append([original_start + (low - trimmed_start), original_start + (high - trimmed_start), low - start])
+    return result
+
+
+def split_recording(source_file, spool_dir):
+    """
+    Split a long recording into consecutive time segments, each with the frames shown during it.
+
+    :param source_file: Dict describing the (preprocessed) recording, as returned by prepare_upload.
+    :param spool_dir: Directory that holds the spooled files.
+    :return: A list of segment dicts, empty if the recording is short enough to process whole.
+    """
+    duration = probe_duration(source_file["path"])
+    count = segment_count(duration, SEGMENT_SECONDS)
+    if count == 1:
+        return []
+
+    length = duration / count
+    extension = os.path.splitext(source_file["path"])[1]
+    segments = []
+    for index in range(count):
+        start, end = index * length, (index + 1) * length
+        key = variant_key(source_file["key"], f"segment:{index}:{count}")
+        output_path = os.path.join(spool_dir, f"{key}{extension}")
+        if not reuse_output(output_path):
+            run_ffmpeg(["-ss", f"{start:.3f}", "-t", f"{length:.3f}", "-i", source_file["path"], "-c", "copy"],
+                       output_path)
+
+        # Frames are relabelled with their position in the segment, like the audio the model hears
+        attachments = [
+            {**attachment, "label": f"[Frame at {format_timestamp(attachment['time'] - start)}]"}
+            for attachment in source_file.get("attachments") or []
+            if start <= attachment.get("time", -1) < end
+        ]
+        timeline = segment_timeline(source_file.get("timeline"), start, end)
+        spans = timeline or [[start, end, 0.0]]
+        segments.append({
+            **source_file,
+            "path": output_path,
+            "key": key,
+            "attachments": attachments,
+            "timeline": timeline,
+            "label": (f"part {index + 1} of {count} of the recording "
+                      f"({format_timestamp(spans[0][0])} to {format_timestamp(spans[-1][1])})")
+        })
+    return segments
+
+
+def write_pdf_pages(reader, page_indexes, output_path):
+    """
+    Write some pages of a PDF to a new file (unless it already exists).
+
+    :param reader: A pypdf.PdfReader of the source document.
+    :param page_indexes: Zero-based indexes of the pages to copy.
+    :param output_path: Where to write the new PDF.
+    """
+    if reuse_output(output_path):
+        return
+    writer = pypdf.PdfWriter()
+    for index in page_indexes:
+        writer.add_page(reader.pages[index])
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_path), suffix=".pdf")
+    with os.fdopen(fd, "wb") as f:
+        writer.write(f)
+    os.replace(tmp_path, output_path)
+
+
+def split_document(source_file, spool_dir):
+    """
+    Split a long document into consecutive page ranges.
+
+    Works on the text layer produced by extract_pdf_text (splitting at its page markers, with
+    the matching image pages attached) and on PDFs sent unchanged.
+
+    :param source_file: Dict describing the (preprocessed) document, as returned by prepare_upload.
+    :param spool_dir: Directory that holds the spooled files.
+    :return: A list of segment dicts, empty if the document is short enough to process whole.
+    """
+    if source_file["mime_type"] == "application/pdf":
+        reader = pypdf.PdfReader(source_file["path"])
+        if reader.is_encrypted:
+            reader.decrypt("")
+        count = segment_count(len(reader.pages), SEGMENT_PAGES)
+        if count == 1:
+            return []
+        size = math.ceil(len(reader.pages) / count)
+        segments = []
+        for index, first in enumerate(range(0, len(reader.pages), size)):
+            last = min(first + size, len(reader.pages))
+            key = variant_key(source_file["key"], f"segment:{index}:{count}")
+            output_path = os.path.join(spool_dir, f"{key}.pdf")
+            write_pdf_pages(reader, range(first, last), output_path)
+            segments.append({**source_file, "path": output_path, "key": key,
+                             "label": f"pages {first + 1} to {last} of the document"})
+        return segments
+
+    with open(source_file["path"], encoding="utf-8") as f:
+        sections = re.split(r"(?m)^(?=--- Page \d+ ---$)", f.read())
+    sections = [section for section in sections if section.strip()]
+    count = segment_count(len(sections), SEGMENT_PAGES)
+    if count == 1:
+        return []
+
+    fallback = next(iter(source_file.get("attachments") or []), None)
+    fallback_reader = pypdf.PdfReader(fallback["path"]) if fallback else None
+    size = math.ceil(len(sections) / count)
+    segments = []
+    for index, first in enumerate(range(0, len(sections), size)):
+        last = min(first + size, len(sections))
+        key = variant_key(source_file["key"], f"segment:{index}:{count}")
+        output_path = os.path.join(spool_dir, f"{key}.txt")
+        if not reuse_output(output_path):
+            with open(output_path, "w", encoding="utf-8") as f:
+                f.write("".join(sections[first:last]))
+
+        # Attach the image pages that fall inside this page range
+        attachments = []
+        if fallback:
+            indexes = [i for i, page in enumerate(fallback["pages"]) if first < page <= last]
+            if indexes:
+                pages = [fallback["pages"][i] for i in indexes]
+                pages_path = os.path.join(spool_dir, f"{key}.pages.pdf")
+                write_pdf_pages(fallback_reader, indexes, pages_path)
+                label = f"[{'Pages' if len(pages) > 1 else 'Page'} {', '.join(map(str, pages))} as images]"
+                attachments.append({"path": pages_path, "mime_type": "application/pdf", "label": label,
+                                    "pages": pages})
+
+        segments.append({**source_file, "path": output_path, "key": key, "attachments": attachments,
+                         "label": f"pages {first + 1} to {last} of the document"})
+    return segments
+
+
+def split_segments(source_file, spool_dir):
+    """
+    Split long recordings by time and long documents by page range for map-reduce processing.
+
+    :param source_file: Dict describing the preprocessed upload, as returned by prepare_upload.
+    :param spool_dir: Directory that holds the spooled files.
+    :return: A (segments, report) tuple. Segments are source_file dicts with a "label" describing
+             which part of the material they cover; the list is empty for short material.
+    """
+    mime_type = source_file["mime_type"] or ""
+    try:
+        if mime_type.startswith(("audio/", "video/")):
+            if not FFMPEG:
+                return [], []
+            segments = split_recording(source_file, spool_dir)
+        elif mime_type == "application/pdf" or source_file.get("page_count"):
+            segments = split_document(source_file, spool_dir)
+        else:
+            return [], []
+    except (OSError, ValueError, subprocess.CalledProcessError, pypdf.errors.PyPdfError) as e:
+        return [], [f"Long material is processed in one piece: it could not be split ({e})."]
+
+    if not segments:
+        return [], []
+    return segments, [f"Long material split into {len(segments)} segments that are analysed in parallel."]
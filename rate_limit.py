@@ -0,0 +1,147 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    A bucket that refills at a steady rate up to its capacity, e.g. a per-minute quota.
+
+    The level may go below zero when more was used than expected, later takers then wait
+    until the bucket has refilled past that debt (at most one period's worth).
+    """
+
+    def __init__(self, capacity, period_seconds=60.0):
+        """
+        :param capacity: Amount available per period (e.g. requests per minute).
+        :param period_seconds: The period the capacity refills over.
+        """
+        self.capacity = capacity
+        self.rate = capacity / period_seconds
+        self.level = float(capacity)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def available(self):
+        """
+        :return: The amount currently in the bucket (negative while in debt).
+        """
+        self._refill()
+        return self.level
+
+    def wait_time(self, amount):
+        """
+        :param amount: The amount to take.
+        :return: Seconds until the bucket holds that amount (0 if it already does). Amounts over
+                 the capacity only wait for a full bucket, so they can't block forever.
+        """
+        self._refill()
+        return max(min(amount, self.capacity) - self.level, 0.0) / self.rate
+
+    def take(self, amount):
+        """
+        Take an amount from the bucket, or put it back with a negative amount.
+
+        :param amount: The amount to take.
+        """
+        self._refill()
+        self.level = max(min(self.capacity, self.level - amount), -self.capacity)
+
+
+class RateLimiter:
+    """
+    Keep the calls to a model under its requests-per-minute and tokens-per-minute quotas.
+
+    Every session shares the API key, so the limiter is shared by the whole process. Calls that
+    would exceed a quota wait in line (first come, first served) until the buckets have refilled
+    instead of being sent and rejected with a 429. Token counts are estimates, they are corrected
+    with the actual usage once a call has finished.
+
+    All waiting happens on the shared event loop, so acquire must be awaited from coroutines
+    running on that loop.
+    """
+
+    def __init__(self, name, metrics, requests_per_minute=1000, tokens_per_minute=1_000_000):
+        """
+        :param name: Name of the quota (e.g. the model), used in metric labels.
+        :param metrics: The Metrics receiving the waits and the state of the buckets.
+        :param requests_per_minute: Requests allowed per minute, 0 for no limit.
+        :param tokens_per_minute: Input tokens allowed per minute, 0 for no limit.
+        """
+        self.name = name
+        self.metrics = metrics
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self._lock = threading.Lock()
+        self._line = asyncio.Lock()
+        self._queued = 0
+
+    def _wait_time(self, tokens):
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens))
+        return wait
+
+    def _take(self, requests, tokens):
+        if self.requests is not None:
+            self.requests.take(requests)
+        if self.tokens is not None:
+            self.tokens.take(tokens)
+
+    def _publish(self):
+        with self._lock:
+            for quota, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+                if bucket is not None:
+                    self.metrics.set_gauge(
+                        "rate_limit_available", round(bucket.available()), model=self.name, quota=quota
+                    )
+            self.metrics.set_gauge("rate_limit_queued", self._queued, model=self.name)
+
+    async def acquire(self, tokens):
+        """
+        Wait until a request with the given number of tokens fits in the quotas, and take it from them.
+
+        :param tokens: Estimated input tokens of the request.
+        """
+        start = time.monotonic()
+        delayed = False
+        with self._lock:
+            self._queued += 1
+        self._publish()
+        try:
+            # Only the head of the line waits for the buckets, the others wait for their turn
+            async with self._line:
+                while True:
+                    with self._lock:
+                        wait = self._wait_time(tokens)
+                        if wait <= 0:
+                            self._take(1, tokens)
+                            break
+                    delayed = True
+                    await asyncio.sleep(wait)
+        finally:
+            with self._lock:
+                self._queued -= 1
+            self._publish()
+
+        self.metrics.observe("rate_limit_wait_seconds", time.monotonic() - start, model=self.name)
+        if delayed:
+            self.metrics.increment("rate_limit_delayed_total", model=self.name)
+
+    def debit(self, tokens, requests=0):
+        """
+        Take from the quotas without waiting, for calls that are sent anyway (e.g. hedged duplicates)
+        or to correct an estimate once the actual usage is known.
+
+        :param tokens: Input tokens to take, negative to give back an overestimate.
+        :param requests: Requests to take.
+        """
+        with self._lock:
+            self._take(requests, tokens)
+        self._publish()
@@ -0,0 +1,365 @@
+import asyncio
+import collections
+import email.utils
+import logging
+import random
+import re
+import threading
+import time
+
+import httpx
+from google.genai import errors
+
+logger = logging.getLogger("student_assistant")
+
+# Status codes worth retrying: request timeout, rate limiting and server side failures
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class GenerationError(Exception):
+    """
+    A model call that failed, with a message that can be shown to the user as is.
+
+    :ivar status: The HTTP status code returned by the API, or None for network and other errors.
+    :ivar retry_after: Seconds the server asked us to wait before trying again, if it said so.
+    :ivar attempts: How many attempts were made before giving up.
+    """
+    retryable = False
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.attempts = 1
+
+
+class RateLimitError(GenerationError):
+    """The API rejected the call because of rate limits or quota (429)."""
+    retryable = True
+
+
+class ServiceUnavailableError(GenerationError):
+    """The API or the network failed temporarily (5xx, timeouts, dropped connections)."""
+    retryable = True
+
+
+class CircuitOpenError(GenerationError):
+    """The model is failing, calls are rejected without being sent until it has recovered."""
+
+
+def parse_retry_after(value):
+    """
+    Parse a Retry-After header, given either in seconds or as an HTTP date.
+
+    :param value: The header value.
+    :return: The delay in seconds, or None if it can't be parsed.
+    """
+    try:
+        return max(float(value), 0.0)
+    except (TypeError, ValueError):
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(retry_at.timestamp() - time.time(), 0.0)
+
+
+def retry_hint(error):
+    """
+    Find out how long the server asked us to wait, from the Retry-After header or the
+    google.rpc.RetryInfo detail (e.g. "retryDelay": "17s") of an API error.
+
+    :param error: The errors.APIError raised by the SDK.
+    :return: The delay in seconds, or None if the server gave no hint.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers and headers.get("retry-after"):
+        delay = parse_retry_after(headers.get("retry-after"))
+        if delay is not None:
+            return delay
+
+    details = error.details if isinstance(error.details, dict) else {}
+    for detail in details.get("error", details).get("details") or []:
+        if isinstance(detail, dict) and str(detail.get("@type", "")).endswith("RetryInfo"):
+            match = re.fullmatch(r"([\d.]+)s", str(detail.get("retryDelay", "")))
+            if match:
+                return float(match.group(1))
+    return None
+
+
+def classify(error):
+    """
+    Turn any exception raised by a model call into a GenerationError.
+
+    :param error: The exception raised by the SDK or the HTTP client.
+    :return: The GenerationError (or subclass) describing it.
+    """
+    if isinstance(error, GenerationError):
+        return error
+    if isinstance(error, errors.APIError):
+        detail = error.message or error.status or str(error)
+        hint = retry_hint(error)
+        if error.code == 429:
+            return RateLimitError(
+                f"Gemini is receiving too many requests right now (429): {detail}", status=429, retry_after=hint
+            )
+        if error.code in RETRYABLE_STATUS_CODES:
+            return ServiceUnavailableError(
+                f"Gemini is temporarily unavailable ({error.code}): {detail}", status=error.code, retry_after=hint
+            )
+        return GenerationError(f"Gemini rejected the request ({error.code}): {detail}", status=error.code)
+    if isinstance(error, (httpx.TimeoutException, TimeoutError)):
+        return ServiceUnavailableError(f"Gemini did not answer in time: {str(error) or type(error).__name__}")
+    if isinstance(error, httpx.TransportError):
+        return ServiceUnavailableError(f"Could not reach Gemini: {error}")
+    return GenerationError(str(error) or type(error).__name__)
+
+
+class RetryPolicy:
+    """
+    Retry transient failures of a single call with capped exponential backoff and full jitter.
+
+    Every call has its own budget: at most max_attempts attempts, and no retry that would end
+    more than budget_seconds after the first attempt started. A delay requested by the server
+    (Retry-After / RetryInfo) is waited out in full, so it can end the retries early when it
+    doesn't fit in the budget.
+    """
+
+    def __init__(self, max_attempts=4, base_delay=1.0, max_delay=30.0, budget_seconds=90.0):
+        """
+        :param max_attempts: Maximum number of attempts per call, including the first one.
+        :param base_delay: Upper bound of the first backoff delay, in seconds.
+        :param max_delay: Cap of the backoff delay, in seconds.
+        :param budget_seconds: Total time a call may spend including its retries, in seconds.
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_seconds = budget_seconds
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Compute how long to wait before the next attempt.
+
+        :param attempt: Number of attempts made so far (1 after the first failure).
+        :param retry_after: Delay requested by the server, if any.
+        :return: The delay in seconds.
+        """
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    async def call(self, function, metrics, breaker=None, **labels):
+        """
+        Await a call, retrying it while it fails with a retryable error and the budget allows.
+
+        :param function: Callable returning a new awaitable for every attempt.
+        :param metrics: The Metrics receiving the retry counts and delays.
+        :param breaker: Optional CircuitBreaker of the backend, asked before and told after every attempt.
+        :param labels: Labels for the metrics (e.g. the model).
+        :return: The result of the first successful attempt.
+        :raises GenerationError: If the call failed for good (CircuitOpenError if the breaker rejected it).
+        """
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if breaker is not None:
+                    breaker.before_call()
+                result = await function()
+                if breaker is not None:
+                    breaker.record(True)
+            except Exception as e:
+                error = classify(e)
+                if breaker is not None and not isinstance(error, CircuitOpenError):
+                    # Only outages count against the backend, an answer like 400 or 429 means it is up
+                    breaker.record(not isinstance(error, ServiceUnavailableError))
+                error.attempts = attempt
+                delay = self.delay(attempt, error.retry_after)
+                reason = error.status or "network"
+                if (
+                    not error.retryable
+                    or attempt >= self.max_attempts
+                    or time.monotonic() - start + delay > self.budget_seconds
+                ):
+                    metrics.increment("gemini_calls_total", outcome="error", **labels)
+                    metrics.observe("gemini_call_attempts", attempt, **labels)
+                    if error is e:
+                        raise
+                    raise error from e
+
+                metrics.increment("gemini_retries_total", reason=reason, **labels)
+                metrics.observe("gemini_retry_delay_seconds", delay, **labels)
+                logger.info("Gemini call failed (%s), retry %d in %.1fs: %s", reason, attempt, delay, error)
+                await asyncio.sleep(delay)
+                continue
+
+            metrics.increment("gemini_calls_total", outcome="ok", **labels)
+            metrics.observe("gemini_call_attempts", attempt, **labels)
+            return result
+
+
+async def hedge(function, delay, metrics, discard=None, **labels):
+    """
+    Await a call, starting a duplicate if it hasn't finished after a delay and keeping whichever
+    finishes first. The other one is cancelled.
+
+    A duplicate that fails doesn't fail the call as long as the other one can still succeed.
+
+    :param function: Callable returning a new awaitable for every copy of the call.
+    :param delay: Seconds to wait for the first copy before starting the duplicate, or None to never hedge.
+    :param metrics: The Metrics receiving the hedge counts.
+    :param discard: Optional async callable receiving the result of a copy that also succeeded but
+                    finished second (e.g. to close an opened stream).
+    :param labels: Labels for the metrics (e.g. the model).
+    :return: The result of the first copy that succeeded.
+    """
+    if delay is None:
+        return await function()
+
+    metrics.increment("gemini_hedge_candidates_total", **labels)
+    primary = asyncio.ensure_future(function())
+    tasks = [primary]
+    winner = None
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=delay)
+        if not done:
+            metrics.increment("gemini_hedges_total", **labels)
+            tasks.append(asyncio.ensure_future(function()))
+
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not primary:
+                        metrics.increment("gemini_hedge_wins_total", **labels)
+                    winner = task
+                    return task.result()
+        # Every copy failed, report the original failure
+        return primary.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+            # A copy that finished at the same time as the winner can't be cancelled anymore
+            if discard is None or task is winner or not task.done() or task.cancelled():
+                continue
+            if task.exception() is None:
+                await discard(task.result())
+
+
+class CircuitBreaker:
+    """
+    Stop calling a backend that keeps failing, instead of letting every session wait for it to time out.
+
+    The breaker is closed while the backend is healthy. It opens once failure_rate of the calls
+    in the last window_seconds failed (with at least min_calls calls), and then rejects every call
+    for open_seconds. After that it is half-open: a single probe call is let through, which closes
+    the breaker again if it succeeds and reopens it if it fails.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, metrics, failure_rate=0.5, min_calls=5, window_seconds=60.0, open_seconds=30.0):
+        """
+        :param name: Name of the backend (e.g. the model), used in messages and metric labels.
+        :param metrics: The Metrics receiving the state changes and rejected calls.
+        :param failure_rate: Fraction of failed calls that opens the breaker.
+        :param min_calls: Minimum number of calls in the window before the failure rate is considered.
+        :param window_seconds: How far back calls are taken into account.
+        :param open_seconds: How long the breaker rejects calls before probing the backend again.
+        """
+        self.name = name
+        self.metrics = metrics
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self._lock = threading.Lock()
+        self._results = collections.deque()
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._probe_started = None
+
+    @property
+    def state(self):
+        """The current state: CLOSED, OPEN or HALF_OPEN (open, but ready for a probe call)."""
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                return self.HALF_OPEN
+            return self._state
+
+    def retry_in(self):
+        """
+        :return: Seconds until the breaker lets a probe call through (0 if it does already).
+        """
+        with self._lock:
+            if self._state != self.OPEN:
+                return 0.0
+            return max(self._opened_at + self.open_seconds - time.monotonic(), 0.0)
+
+    def before_call(self):
+        """
+        Ask for permission to call the backend.
+
+        :raises CircuitOpenError: If the breaker is open, or half-open with a probe already in flight.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._state == self.OPEN and now - self._opened_at >= self.open_seconds:
+                self._change(self.HALF_OPEN)
+            if self._state == self.HALF_OPEN:
+                # A probe that never reported back (e.g. it was cancelled) doesn't block recovery forever
+                if self._probe_started is None or now - self._probe_started >= self.open_seconds:
+                    self._probe_started = now
+                    return
+            if self._state == self.CLOSED:
+                return
+            retry_in = max(self._opened_at + self.open_seconds - now, 0.0)
+
+        self.metrics.increment("circuit_rejections_total", model=self.name)
+        raise CircuitOpenError(
+            f"{self.name} is currently failing, so requests are paused for about {retry_in:.0f}s to let it recover.",
+            retry_after=retry_in
+        )
+
+    def record(self, success):
+        """
+        Report the outcome of a call that was let through.
+
+        :param success: False if the backend failed (5xx, timeout, network error).
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._state == self.HALF_OPEN:
+                self._probe_started = None
+                self._results.clear()
+                if success:
+                    self._change(self.CLOSED)
+                else:
+                    self._opened_at = now
+                    self._change(self.OPEN)
+                return
+            if self._state == self.OPEN:
+                return
+
+            self._results.append((now, success))
+            while self._results and self._results[0][0] < now - self.window_seconds:
+                self._results.popleft()
+            failures = sum(1 for _, ok in self._results if not ok)
+            if len(self._results) >= self.min_calls and failures / len(self._results) >= self.failure_rate:
+                self._results.clear()
+                self._opened_at = now
+                self._change(self.OPEN)
+
+    def _change(self, state):
+        self._state = state
+        self.metrics.increment("circuit_state_changes_total", model=self.name, state=state)
+        log = logger.warning if state == self.OPEN else logger.info
+        log("Circuit breaker for %s is now %s", self.name, state)
@@ -0,0 +1,138 @@
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class ResultCache:
+    """
+    Process-wide cache for generated artifacts, shared by every session.
+
+    Entries live in memory with LRU + TTL eviction and can optionally be written to a
+    directory on disk so they survive restarts. Concurrent lookups of the same missing key
+    wait for a single computation instead of all calling the model.
+    """
+
+    def __init__(self, max_entries=256, ttl_seconds=24 * 60 * 60, disk_dir=None):
+        """
+        :param max_entries: Maximum number of entries kept in memory.
+        :param ttl_seconds: How long an entry stays valid, in memory and on disk.
+        :param disk_dir: Optional directory for the on-disk tier.
+        """
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key):
+        """
+        Look up a cached value.
+
+        :param key: A tuple of JSON serializable values identifying the result.
+        :return: The cached value, or None if it is missing or expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, value = entry
+                if time.time() - created < self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+
+        entry = self._read_disk(key)
+        if entry is None:
+            return None
+        created, value = entry
+        self._store_memory(key, value, created)
+        return value
+
+    def set(self, key, value):
+        """
+        Store a value in memory and, if configured, on disk.
+
+        :param key: A tuple of JSON serializable values identifying the result.
+        :param value: The JSON serializable value to store.
+        """
+        created = time.time()
+        self._store_memory(key, value, created)
+        self._write_disk(key, value, created)
+
+    def get_or_compute(self, key, compute, cacheable=lambda value: True):
+        """
+        Return the cached value for a key, computing and storing it on a miss.
+
+        :param key: A tuple of JSON serializable values identifying the result.
+        :param compute: Callable that produces the value.
+        :param cacheable: Predicate deciding whether a computed value may be stored (e.g. not empty).
+        :return: The cached or freshly computed value.
+        :raises Exception: Whatever compute raised, nothing is stored in that case.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        try:
+            with key_lock:
+                # Another session may have computed it while we were waiting
+                value = self.get(key)
+                if value is None:
+                    value = compute()
+                    if cacheable(value):
+                        self.set(key, value)
+        finally:
+            with self._lock:
+                self._key_locks.pop(key, None)
+        return value
+
+    def _store_memory(self, key, value, created):
+        with self._lock:
+            self._entries[key] = (created, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        name = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.disk_dir, f"{name}.json")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry["created"] >= self.ttl_seconds:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry["created"], entry["value"]
+
+    def _write_disk(self, key, value, created):
+        if not self.disk_dir:
+            return
+        # Write to a temporary file first so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"key": list(key), "created": created, "value": value}, f)
+            os.replace(tmp_path, self._disk_path(key))
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
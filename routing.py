@@ -0,0 +1,214 @@
+import logging
+import threading
+
+import rate_limit
+import resilience
+
+logger = logging.getLogger("student_assistant")
+
+# Model tiers from the most capable to the fastest, later tiers are the fallbacks of earlier ones
+DEFAULT_TIERS = {
+    "quality": "gemini-2.5-flash",
+    "standard": "gemini-2.0-flash",
+    "fast": "gemini-2.0-flash-lite",
+}
+
+# The tier each workflow task runs on
+DEFAULT_TASK_TIERS = {
+    "transcript": "standard",
+    "concept_map": "quality",
+    "flashcards": "standard",
+    "first_question": "fast",
+    "grading": "standard",
+}
+
+# Latency objective of each task in seconds, a model that is slower than this is skipped
+DEFAULT_TASK_SLOS = {
+    "transcript": 180,
+    "concept_map": 60,
+    "flashcards": 45,
+    "first_question": 10,
+    "grading": 15,
+}
+
+# Paid tier prices in USD per million input and output tokens (text, image and video input)
+PRICES = {
+    "gemini-2.5-pro": (1.25, 10.00),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+    "gemini-2.0-flash": (0.10, 0.40),
+    "gemini-2.0-flash-lite": (0.075, 0.30),
+}
+
+
+def parse_mapping(value, convert=str):
+    """
+    Parse a mapping setting, given as a table in Streamlit Secrets or as "key=value,key=value" text.
+
+    :param value: The setting value (a dict, a string or None).
+    :param convert: Conversion applied to every value.
+    :return: The parsed dict, in the order it was given.
+    """
+    if not value:
+        return {}
+    if hasattr(value, "items"):
+        return {str(key): convert(item) for key, item in value.items()}
+    mapping = {}
+    for entry in str(value).split(","):
+        key, _, item = entry.partition("=")
+        if key.strip() and item.strip():
+            mapping[key.strip()] = convert(item.strip())
+    return mapping
+
+
+def cost(model, input_tokens, output_tokens):
+    """
+    Estimate the price of a call.
+
+    :param model: The model that handled the call.
+    :param input_tokens: Number of prompt tokens.
+    :param output_tokens: Number of generated tokens, including thinking tokens.
+    :return: The price in USD, or None for models without a known price.
+    """
+    if model not in PRICES:
+        return None
+    input_price, output_price = PRICES[model]
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+
+class Router:
+    """
+    Choose the model for each workflow task from configurable tiers.
+
+    Every task has a tier and a latency objective. While the recent latency of a task on its
+    model exceeds the objective, the task falls back to the next faster tier. Once those slow
+    samples are older than the window, the model is tried again. Models whose circuit breaker
+    is open are skipped the same way. Every model also has its own rate limiter, since quotas
+    are set per model.
+    """
+
+    def __init__(self, metrics, tiers=None, task_tiers=None, task_slos=None, percentile=90,
+                 window_seconds=600, min_samples=5, breaker_options=None, limiter_options=None):
+        """
+        :param metrics: The Metrics holding the "task_seconds" latencies recorded for every call.
+        :param tiers: Mapping of tier name to model, from the most capable to the fastest.
+        :param task_tiers: Mapping of task to tier name, tasks that are missing use the last tier.
+        :param task_slos: Mapping of task to its latency objective in seconds.
+        :param percentile: The latency percentile compared to the objective.
+        :param window_seconds: How far back latency samples are taken into account.
+        :param min_samples: Number of recent samples needed before a model is considered slow.
+        :param breaker_options: Keyword arguments for the resilience.CircuitBreaker of every model.
+        :param limiter_options: Keyword arguments for the rate_limit.RateLimiter of every model.
+        """
+        self.metrics = metrics
+        self.tiers = dict(tiers or DEFAULT_TIERS)
+        self.task_tiers = {**DEFAULT_TASK_TIERS, **(task_tiers or {})}
+        self.task_slos = {**DEFAULT_TASK_SLOS, **(task_slos or {})}
+        self.percentile = percentile
+        self.window_seconds = window_seconds
+        self.min_samples = min_samples
+        self.breaker_options = breaker_options or {}
+        self.limiter_options = limiter_options or {}
+        self._breakers = {}
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, model):
+        """
+        Get the circuit breaker guarding calls to a model.
+
+        :param model: The model name.
+        :return: The resilience.CircuitBreaker of that model.
+        """
+        with self._lock:
+            if model not in self._breakers:
+                self._breakers[model] = resilience.CircuitBreaker(model, self.metrics, **self.breaker_options)
+            return self._breakers[model]
+
+    def limiter(self, model):
+        """
+        Get the rate limiter keeping the calls to a model within its quotas.
+
+        :param model: The model name.
+        :return: The rate_limit.RateLimiter of that model.
+        """
+        with self._lock:
+            if model not in self._limiters:
+                self._limiters[model] = rate_limit.RateLimiter(model, self.metrics, **self.limiter_options)
+            return self._limiters[model]
+
+    def open_breakers(self):
+        """
+        :return: The circuit breakers that are currently rejecting calls.
+        """
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return [breaker for breaker in breakers if breaker.state == resilience.CircuitBreaker.OPEN]
+
+    def candidates(self, task):
+        """
+        List the models a task may use, from its own tier to the fastest one.
+
+        :param task: The workflow task, e.g. "concept_map".
+        :return: The list of model names.
+        """
+        names = list(self.tiers)
+        tier = self.task_tiers.get(task)
+        start = names.index(tier) if tier in names else len(names) - 1
+        return [self.tiers[name] for name in names[start:]]
+
+    def is_slow(self, task, model):
+        """
+        Check whether a model recently missed the latency objective of a task.
+
+        :param task: The workflow task.
+        :param model: The model name.
+        :return: True if the task should avoid this model for now.
+        """
+        slo = self.task_slos.get(task)
+        if slo is None:
+            return False
+        latency = self.metrics.percentile(
+            "task_seconds", self.percentile, max_age=self.window_seconds, min_samples=self.min_samples,
+            task=task, model=model
+        )
+        return latency is not None and latency > slo
+
+    def choose(self, task, record=True):
+        """
+        Choose the model for a task, skipping models that are currently failing or too slow for it.
+
+        :param task: The workflow task.
+        :param record: Count and log a fallback (disable when only projecting a workflow).
+        :return: The model name.
+        """
+        models = self.candidates(task)
+        available = [model for model in models if self.breaker(model).state != resilience.CircuitBreaker.OPEN]
+        model = next((model for model in available if not self.is_slow(task, model)), None)
+        if model is None:
+            # Everything is slow or failing: prefer a model that still answers, or let the breaker fail fast
+            model = available[-1] if available else models[0]
+        if record and model != models[0]:
+            self.metrics.increment("model_fallbacks_total", task=task, model=model)
+            logger.info("%s is unavailable or too slow on %s, using %s", task, models[0], model)
+        return model
+
+    def record(self, task, model, seconds, usage=None):
+        """
+        Record the latency, tokens and cost of a finished call.
+
+        :param task: The workflow task.
+        :param model: The model that handled the call.
+        :param seconds: The latency of the call.
+        :param usage: The usage_metadata of the response, if available.
+        """
+        self.metrics.observe("task_seconds", seconds, task=task, model=model)
+        if usage is None:
+            return
+        input_tokens = usage.prompt_token_count or 0
+        output_tokens = (usage.candidates_token_count or 0) + (usage.thoughts_token_count or 0)
+        self.metrics.increment("task_input_tokens_total", input_tokens, task=task, model=model)
+        self.metrics.increment("task_output_tokens_total", output_tokens, task=task, model=model)
+        price = cost(model, input_tokens, output_tokens)
+        if price is not None:
+            self.metrics.increment("task_cost_usd_total", price, task=task, model=model)
@@ -0,0 +1,140 @@
+import threading
+import time
+import unittest
+
+import pipeline
+import result_cache
+
+
+def node(name, function, inputs=(), **kwargs):
+    return pipeline.Node(name, function, inputs, **kwargs)
+
+
+class PipelineTest(unittest.TestCase):
+    def test_runs_nodes_in_dependency_order(self):
+        p = pipeline.Pipeline([
+            node("b", lambda a: a + "b", ("a",)),
+            node("a", lambda: "a"),
+            node("c", lambda a, b: a + b + "c", ("a", "b")),
+        ])
+        outputs, errors = p.run()
+        self.assertEqual(errors, {})
+        self.assertEqual(outputs, {"a": "a", "b": "ab", "c": "aabc"})
+
+    def test_independent_nodes_run_concurrently(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def wait(a):
+            barrier.wait()
+            return a
+
+        p = pipeline.Pipeline([node("a", lambda: 1), node("b", wait, ("a",)), node("c", wait, ("a",))])
+        outputs, errors = p.run()
+        self.assertEqual(errors, {})
+        self.assertEqual((outputs["b"], outputs["c"]), (1, 1))
+
+    def test_targets_only_run_what_they_need(self):
+        calls = []
+
+        def make(name, result):
+            def function(**inputs):
+                calls.append(name)
+                return result
+            return function
+
+        p = pipeline.Pipeline([
+            node("a", make("a", 1)),
+            node("b", make("b", 2), ("a",)),
+            node("c", make("c", 3), ("a",)),
+        ])
+        outputs, _ = p.run(targets=["b"])
+        self.assertEqual(sorted(calls), ["a", "b"])
+        self.assertNotIn("c", outputs)
+
+    def test_known_values_are_not_run(self):
+        p = pipeline.Pipeline([node("a", lambda: self.fail("a ran")), node("b", lambda a: a * 2, ("a",))])
+        outputs, errors = p.run(values={"a": 21})
+        self.assertEqual(errors, {})
+        self.assertEqual(outputs["b"], 42)
+
+    def test_forced_node_dependents_wait_for_the_new_output(self):
+        def a():
+            time.sleep(0.05)
+            return "A2"
+
+        p = pipeline.Pipeline([node("a", a), node("b", lambda a: a, ("a",))])
+        outputs, errors = p.run(values={"a": "A1", "b": "B1"}, force=("a", "b"))
+        self.assertEqual(errors, {})
+        self.assertEqual(outputs, {"a": "A2", "b": "A2"})
+
+    def test_failure_skips_dependents(self):
+        def fail():
+            raise RuntimeError("boom")
+
+        p = pipeline.Pipeline([node("a", fail), node("b", lambda a: a, ("a",)), node("c", lambda: 3)])
+        outputs, errors = p.run()
+        self.assertIsInstance(errors["a"], RuntimeError)
+        self.assertIsInstance(errors["b"], pipeline.PipelineError)
+        self.assertEqual(outputs, {"c": 3})
+
+    def test_on_update_reports_every_step(self):
+        updates = []
+        p = pipeline.Pipeline([node("a", lambda: 1), node("b", lambda a: a + 1, ("a",))])
+        p.run(on_update=lambda name, status, result: updates.append((name, status, result)))
+        self.assertEqual(updates, [("a", "running", None), ("a", "done", 1), ("b", "running", None), ("b", "done", 2)])
+
+    def test_invalid_graphs_are_rejected(self):
+        with self.assertRaises(ValueError):
+            pipeline.Pipeline([node("a", lambda b: b, ("b",))])
+        with self.assertRaises(ValueError):
+            pipeline.Pipeline([node("a", lambda b: b, ("b",)), node("b", lambda a: a, ("a",))])
+
+
+class PipelineCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = result_cache.ResultCache()
+        self.calls = []
+        self.prompt = "v1"
+
+    def pipeline(self, source=lambda: "material"):
+        def summarize(source, prompt):
+            self.calls.append("summary")
+            return f"{prompt}:{source}"
+
+        return pipeline.Pipeline([
+            node("source", source, cacheable=False),
+            node("summary", summarize, ("source",), params=lambda: {"prompt": self.prompt}),
+        ])
+
+    def test_unchanged_nodes_come_from_the_cache(self):
+        updates = []
+        self.pipeline().run(cache=self.cache)
+        outputs, _ = self.pipeline().run(
+            cache=self.cache, on_update=lambda name, status, result: updates.append((name, status))
+        )
+        self.assertEqual(self.calls, ["summary"])
+        self.assertEqual(outputs["summary"], "v1:material")
+        self.assertIn(("summary", "cached"), updates)
+
+    def test_changed_params_recompute(self):
+        self.pipeline().run(cache=self.cache)
+        self.prompt = "v2"
+        outputs, _ = self.pipeline().run(cache=self.cache)
+        self.assertEqual(self.calls, ["summary", "summary"])
+        self.assertEqual(outputs["summary"], "v2:material")
+
+    def test_force_replaces_the_cached_output(self):
+        self.pipeline().run(cache=self.cache)
+        self.pipeline().run(cache=self.cache, force=("summary",))
+        self.assertEqual(self.calls, ["summary", "summary"])
+
+    def test_outputs_from_a_missing_input_are_not_cached(self):
+        outputs, _ = self.pipeline(source=lambda: None).run(cache=self.cache)
+        self.assertEqual(outputs["summary"], "v1:None")
+        outputs, _ = self.pipeline().run(cache=self.cache)
+        self.assertEqual(outputs["summary"], "v1:material")
+        self.assertEqual(self.calls, ["summary", "summary"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import asyncio
+import unittest
+
+import metrics
+import rate_limit
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_wait_time_grows_with_the_shortfall(self):
+        bucket = rate_limit.TokenBucket(60, period_seconds=60.0)
+        self.assertEqual(bucket.wait_time(60), 0.0)
+        bucket.take(60)
+        self.assertAlmostEqual(bucket.wait_time(30), 30.0, delta=0.1)
+
+    def test_amounts_over_capacity_only_wait_for_a_full_bucket(self):
+        bucket = rate_limit.TokenBucket(60, period_seconds=60.0)
+        bucket.take(60)
+        self.assertAlmostEqual(bucket.wait_time(1000), 60.0, delta=0.1)
+
+    def test_debt_is_limited_to_one_period(self):
+        bucket = rate_limit.TokenBucket(60, period_seconds=60.0)
+        bucket.take(500)
+        self.assertAlmostEqual(bucket.available(), -60.0, delta=0.1)
+        bucket.take(-1000)
+        self.assertAlmostEqual(bucket.available(), 60.0, delta=0.1)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_acquire_takes_from_both_quotas(self):
+        limiter = rate_limit.RateLimiter("model", metrics.Metrics(), requests_per_minute=10, tokens_per_minute=1000)
+        asyncio.run(limiter.acquire(400))
+        self.assertAlmostEqual(limiter.requests.available(), 9, delta=0.1)
+        self.assertAlmostEqual(limiter.tokens.available(), 600, delta=1)
+
+    def test_calls_over_the_quota_wait(self):
+        limiter = rate_limit.RateLimiter("model", metrics.Metrics(), requests_per_minute=600, tokens_per_minute=0)
+        limiter.debit(0, requests=600)
+        loop = asyncio.new_event_loop()
+        try:
+            start = loop.time()
+            loop.run_until_complete(limiter.acquire(0))
+            self.assertGreaterEqual(loop.time() - start, 0.05)
+        finally:
+            loop.close()
+
+    def test_debit_corrects_an_estimate(self):
+        limiter = rate_limit.RateLimiter("model", metrics.Metrics(), requests_per_minute=0, tokens_per_minute=1000)
+        asyncio.run(limiter.acquire(100))
+        limiter.debit(300)
+        self.assertAlmostEqual(limiter.tokens.available(), 600, delta=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+import unittest
+
+import preprocess
+
+# 0-600 s kept, 600-1800 s removed, 1800-4000 s kept
+TIMELINE = [[0.0, 600.0, 0.0], [1800.0, 4000.0, 600.0]]
+
+
+class BuildTimelineTest(unittest.TestCase):
+    def test_silences_are_cut_inside_their_padding(self):
+        padding = preprocess.SILENCE_PADDING
+        timeline = preprocess.build_timeline(100.0, [(40.0, 60.0)])
+        self.assertEqual(timeline, [
+            [0.0, 40.0 + padding, 0.0],
+            [60.0 - padding, 100.0, 40.0 + padding],
+        ])
+
+    def test_leading_and_trailing_silence_is_cut_entirely(self):
+        timeline = preprocess.build_timeline(100.0, [(0.0, 10.0), (90.0, 100.0)])
+        padding = preprocess.SILENCE_PADDING
+        self.assertEqual(timeline, [[10.0 - padding, 90.0 + padding, 0.0]])
+
+    def test_no_silence_keeps_everything(self):
+        self.assertEqual(preprocess.build_timeline(100.0, []), [[0.0, 100.0, 0.0]])
+
+
+class TimeMappingTest(unittest.TestCase):
+    def test_original_time(self):
+        self.assertEqual(preprocess.original_time(300, TIMELINE), 300)
+        self.assertEqual(preprocess.original_time(600, TIMELINE), 1800)
+        self.assertEqual(preprocess.original_time(700, TIMELINE), 1900)
+
+    def test_trimmed_time(self):
+        self.assertEqual(preprocess.trimmed_time(300, TIMELINE), 300)
+        # Inside the removed silence, where the recording resumes
+        self.assertEqual(preprocess.trimmed_time(1000, TIMELINE), 600)
+        self.assertEqual(preprocess.trimmed_time(1900, TIMELINE), 700)
+        self.assertEqual(preprocess.trimmed_time(1900, None), 1900)
+
+
+class RemapTimestampsTest(unittest.TestCase):
+    def test_bracketed_timestamps_are_mapped_back(self):
+        text = "[05:00] Intro\n[12:00] Recursion\n[1:05:00] Wrap-up"
+        self.assertEqual(
+            preprocess.remap_timestamps(text, TIMELINE),
+            "[05:00] Intro\n[32:00] Recursion\n[1:25:00] Wrap-up"
+        )
+
+    def test_other_times_are_left_alone(self):
+        text = 'John 3:16, class ends at 10:30 AM, {"term": "12:00 rule"}'
+        self.assertEqual(preprocess.remap_timestamps(text, TIMELINE), text)
+
+    def test_invalid_seconds_are_left_alone(self):
+        self.assertEqual(preprocess.remap_timestamps("[12:75]", TIMELINE), "[12:75]")
+
+
+class SegmentTimelineTest(unittest.TestCase):
+    def test_untrimmed_first_segment_has_no_timeline(self):
+        self.assertIsNone(preprocess.segment_timeline(None, 0.0, 2400.0))
+
+    def test_untrimmed_later_segment_is_offset(self):
+        timeline = preprocess.segment_timeline(None, 2400.0, 4800.0)
+        self.assertEqual(preprocess.remap_timestamps("[01:00]", timeline), "[41:00]")
+
+    def test_trimmed_segment_maps_to_the_original(self):
+        timeline = preprocess.segment_timeline(TIMELINE, 300.0, 900.0)
+        self.assertEqual(timeline, [[300.0, 600.0, 0.0], [1800.0, 2100.0, 300.0]])
+        self.assertEqual(preprocess.remap_timestamps("[06:00]", timeline), "[31:00]")
+
+
+if __name__ == "__main__":
+    unittest.main()
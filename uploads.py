@@ -0,0 +1,226 @@
+import datetime
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+from google.genai import errors
+from google.genai import types
+
+# How long before its expiry time a remote file is treated as already expired
+EXPIRY_MARGIN = datetime.timedelta(minutes=10)
+
+# Size of the blocks hashed and written while spooling an upload
+SPOOL_CHUNK_SIZE = 1024 * 1024
+
+# Spooled files older than this are removed (remote copies expire after 48 hours anyway)
+SPOOL_MAX_AGE = datetime.timedelta(hours=48)
+
+
+def iter_chunks(stream, chunk_size=SPOOL_CHUNK_SIZE):
+    """
+    Iterate over the content of a binary stream in blocks without copying it.
+
+    In-memory streams (such as Streamlit uploads) are sliced through a memoryview of their
+    buffer, other streams are read block by block.
+
+    :param stream: A seekable binary stream containing the file data.
+    :param chunk_size: Number of bytes per block.
+    :return: An iterator of bytes-like blocks.
+    """
+    if hasattr(stream, "getbuffer"):
+        with stream.getbuffer() as view:
+            for start in range(0, len(view), chunk_size):
+                with view[start:start + chunk_size] as chunk:
+                    yield chunk
+        return
+
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b""):
+        yield chunk
+    stream.seek(0)
+
+
+def spool_upload(stream, spool_dir):
+    """
+    Write an upload to a temporary file named after its SHA-256 digest, hashing it in the same pass.
+
+    Requests and re-uploads then stream from the spooled file, so no additional copy of the
+    upload is held in memory. Identical content is only written once.
+
+    :param stream: A seekable binary stream containing the file data.
+    :param spool_dir: Directory that holds the spooled files.
+    :return: A (path, digest) tuple for the spooled file.
+    """
+    os.makedirs(spool_dir, exist_ok=True)
+    sweep_spool(spool_dir)
+
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=spool_dir, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in iter_chunks(stream):
+                digest.update(chunk)
+                f.write(chunk)
+        path = os.path.join(spool_dir, digest.hexdigest())
+        if os.path.exists(path):
+            os.remove(tmp_path)
+            os.utime(path)
+        else:
+            os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path, digest.hexdigest()
+
+
+def sweep_spool(spool_dir, max_age=SPOOL_MAX_AGE):
+    """
+    Remove spooled files that have not been used for a while.
+
+    :param spool_dir: Directory that holds the spooled files.
+    :param max_age: How long a spooled file is kept after it was last written.
+    """
+    cutoff = time.time() - max_age.total_seconds()
+    for entry in os.scandir(spool_dir):
+        try:
+            if entry.stat().st_mtime >= cutoff:
+                continue
+            if entry.is_dir():
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def file_digest(path):
+    """
+    Compute the SHA-256 digest of a file on disk.
+
+    :param path: Path of the file.
+    :return: The hex digest identifying the file content.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter_chunks(f):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remote_name(digest):
+    """
+    Derive the Files API resource name for a piece of content from its digest.
+
+    :param digest: The hex digest returned by spool_upload.
+    :return: A name of the form "files/<id>" (ids are limited to 40 characters).
+    """
+    return f"files/{digest[:40]}"
+
+
+def find_file(client, name):
+    """
+    Look up a previously uploaded file by name.
+
+    :param client: The genai.Client used for the upload.
+    :param name: The Files API resource name.
+    :return: The types.File, or None if no usable file exists under that name.
+    """
+    try:
+        remote_file = client.files.get(name=name)
+    except errors.ClientError as e:
+        if e.code in (403, 404):
+            return None
+        raise
+    if remote_file.state == types.FileState.FAILED or is_expired(remote_file):
+        delete_file(client, remote_file)
+        return None
+    return remote_file
+
+
+def upload_file(client, source, mime_type, display_name=None, digest=None, poll_interval=2.0, timeout=600.0):
+    """
+    Upload a file once through the Gemini Files API and wait until it can be used in requests.
+
+    If a digest is given the file is stored under a name derived from it, so content that was
+    already uploaded (by this or any other session) is reused instead of being sent again.
+
+    :param client: The genai.Client used for the upload.
+    :param source: A path or seekable binary stream containing the file data.
+    :param mime_type: The MIME type of the file.
+    :param display_name: Optional human readable name shown in the Files API.
+    :param digest: Optional content digest used to name and deduplicate the remote file.
+    :param poll_interval: Seconds to wait between state checks while the file is processing.
+    :param timeout: Maximum number of seconds to wait for the file to become ACTIVE.
+    :return: The ACTIVE types.File returned by the Files API.
+    """
+    name = remote_name(digest) if digest else None
+    remote_file = find_file(client, name) if name else None
+
+    if remote_file is None:
+        if hasattr(source, "seek"):
+            source.seek(0)
+        try:
+            remote_file = client.files.upload(
+                file=source,
+                config=types.UploadFileConfig(name=name, mime_type=mime_type, display_name=display_name)
+            )
+        except errors.ClientError as e:
+            # Another session uploaded the same content first
+            if not (name and e.code == 409):
+                raise
+            remote_file = client.files.get(name=name)
+
+    # Large media files are processed server side before they can be referenced
+    deadline = time.monotonic() + timeout
+    while remote_file.state == types.FileState.PROCESSING:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"File {remote_file.name} was still processing after {timeout:.0f}s")
+        time.sleep(poll_interval)
+        remote_file = client.files.get(name=remote_file.name)
+
+    if remote_file.state == types.FileState.FAILED:
+        raise RuntimeError(f"File {remote_file.name} failed processing: {remote_file.error}")
+    return remote_file
+
+
+def is_expired(remote_file):
+    """
+    Check whether an uploaded file has expired (or is about to) and must be uploaded again.
+
+    :param remote_file: The types.File returned by upload_file.
+    :return: True if the file can no longer be safely referenced.
+    """
+    if remote_file is None:
+        return True
+    if remote_file.expiration_time is None:
+        return False
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return remote_file.expiration_time - EXPIRY_MARGIN <= now
+
+
+def as_part(remote_file):
+    """
+    Build a request Part that references an uploaded file by URI instead of carrying its bytes.
+
+    :param remote_file: The types.File returned by upload_file.
+    :return: A types.Part pointing at the remote file.
+    """
+    return types.Part.from_uri(file_uri=remote_file.uri, mime_type=remote_file.mime_type)
+
+
+def delete_file(client, remote_file):
+    """
+    Delete an uploaded file, ignoring failures since files also expire on their own.
+
+    :param client: The genai.Client used for the upload.
+    :param remote_file: The types.File to delete.
+    """
+    if client is None or remote_file is None:
+        return
+    try:
+        client.files.delete(name=remote_file.name)
+    except Exception:
+        pass